@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+"""
+Benchmark for building initramfs images and unpacking them at boot. Images
+are built out of synthetic root directory (ELF stubs, fake kernel modules
+and sources), so that it can be run on any Linux box without root privileges
+nor real hardware.
+"""
+import argparse
+import gzip
+import json
+import lzma
+import os
+import random
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+import mkinitramfs
+
+
+KERNEL_VER = '6.6.6-bench'
+INTERP = '/lib64/ld-linux-x86-64.so.2'
+APPLETS = ('sh', 'ash', 'blkid', 'cat', 'clear', 'cp', 'dd', 'echo',
+           'grep', 'ifconfig', 'killall', 'ln', 'ls', 'mkdir', 'modprobe',
+           'mount', 'mv', 'reboot', 'rm', 'route', 'seq', 'sleep',
+           'switch_root', 'umount')
+BUSYBOX = """#!/bin/sh
+[ "$1" = "--list" ] && printf '%%s\\n' busybox %s
+"""
+# run by the separate interpreter, result is written on stdout, while the
+# build messages go to stderr
+BUILD_SCRIPT = """
+import json, os, resource, sys, time
+params = json.load(sys.stdin)
+sys.path.insert(0, params['path'])
+import mkinitramfs
+result, sys.stdout = sys.stdout, sys.stderr
+conf = mkinitramfs.Config(*params['conf'])
+start = time.perf_counter()
+cpu = os.times()
+mkinitramfs.Initramfs(conf, params['output']).build()
+end = os.times()
+json.dump({'build': time.perf_counter() - start,
+           'cpu': sum(end[i] - cpu[i] for i in range(4)),
+           'rss': max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                      resource.getrusage(resource.RUSAGE_CHILDREN)
+                      .ru_maxrss)}, result)
+"""
+# binaries with their direct dependencies
+BINARIES = {'/usr/bin/ccrypt': ['libc.so.6'],
+            '/sbin/cryptsetup': ['libcryptsetup.so.12', 'libc.so.6'],
+            '/sbin/lvscan': ['libdevmapper.so.1.02', 'libc.so.6'],
+            '/sbin/vgchange': ['libdevmapper.so.1.02', 'libc.so.6'],
+            '/usr/bin/ykchalresp': ['libykpers-1.so.1', 'libc.so.6']}
+LIBS = {'libc.so.6': [],
+        'libcryptsetup.so.12': ['libdevmapper.so.1.02', 'libcrypto.so.3',
+                                'libargon2.so.1', 'libjson-c.so.5',
+                                'libuuid.so.1', 'libblkid.so.1'],
+        'libdevmapper.so.1.02': ['libm.so.6', 'libc.so.6'],
+        'libcrypto.so.3': ['libz.so.1', 'libc.so.6'],
+        'libargon2.so.1': ['libc.so.6'],
+        'libjson-c.so.5': ['libc.so.6'],
+        'libuuid.so.1': ['libc.so.6'],
+        'libblkid.so.1': ['libuuid.so.1', 'libc.so.6'],
+        'libm.so.6': ['libc.so.6'],
+        'libz.so.1': ['libc.so.6'],
+        'libykpers-1.so.1': ['libusb-1.0.so.0', 'libc.so.6'],
+        'libusb-1.0.so.0': ['libc.so.6'],
+        'libnss_files.so.2': ['libc.so.6'],
+        'libnss_compat.so.2': ['libc.so.6']}
+
+
+def _payload(rnd, size):
+    """
+    Return size bytes of data compressing roughly the same way as machine
+    code does.
+    """
+    chunks = []
+    words = [rnd.randbytes(8) for _ in range(64)]
+    while size > 0:
+        chunk = rnd.randbytes(256) + b''.join(rnd.choice(words)
+                                              for _ in range(96))
+        chunks.append(chunk[:size])
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def make_elf(path, needed=(), interp=None, size=0, seed=0):
+    """
+    Write minimal x86_64 ELF shared object with the dynamic section holding
+    DT_NEEDED entries, padded with pseudo random data up to size bytes.
+    """
+    phnum = 3 if interp else 2
+    offset = 64 + 56 * phnum
+    interp = interp.encode() + b'\0' if interp else b''
+    interp_off = offset
+    strtab_off = interp_off + len(interp)
+    strtab = b'\0'
+    dynamic = []
+    for name in needed:
+        dynamic.append((mkinitramfs.DT_NEEDED, len(strtab)))
+        strtab += name.encode() + b'\0'
+    dyn_off = (strtab_off + len(strtab) + 7) & ~7
+    dynamic.extend([(mkinitramfs.DT_STRTAB, strtab_off),
+                    (mkinitramfs.DT_NULL, 0)])
+    dyn = b''.join(struct.pack('<qQ', tag, val) for tag, val in dynamic)
+    total = max(size, dyn_off + len(dyn))
+
+    data = bytearray(mkinitramfs.ELF_MAGIC + bytes([2, 1, 1]) + bytes(9))
+    data += struct.pack('<HHIQQQIHHHHHH', 3, 62, 1, 0, 64, 0, 0, 64, 56,
+                        phnum, 64, 0, 0)
+    data += struct.pack('<IIQQQQQQ', mkinitramfs.PT_LOAD, 5, 0, 0, 0, total,
+                        total, 4096)
+    data += struct.pack('<IIQQQQQQ', mkinitramfs.PT_DYNAMIC, 6, dyn_off,
+                        dyn_off, dyn_off, len(dyn), len(dyn), 8)
+    if interp:
+        data += struct.pack('<IIQQQQQQ', mkinitramfs.PT_INTERP, 4,
+                            interp_off, interp_off, interp_off, len(interp),
+                            len(interp), 1)
+    data += interp + strtab
+    data += bytes(dyn_off - len(data)) + dyn
+    data += _payload(random.Random(seed), total - len(data))
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as fobj:
+        fobj.write(data)
+    os.chmod(path, 0b111101101)
+
+
+def make_root(path, modules=200, module_size=64, lib_size=512):
+    """
+    Create fake root directory with everything needed for building an image
+    (sizes are in kB).
+    """
+    seed = 0
+    os.makedirs(os.path.join(path, 'bin'))
+    with open(os.path.join(path, 'bin/busybox'), 'w') as fobj:
+        fobj.write(BUSYBOX % ' '.join(APPLETS))
+    os.chmod(os.path.join(path, 'bin/busybox'), 0b111101101)
+
+    make_elf(os.path.join(path, INTERP.lstrip('/')), size=lib_size * 256)
+    for name, needed in LIBS.items():
+        seed += 1
+        make_elf(os.path.join(path, 'lib64', name), needed,
+                 size=lib_size * 1024, seed=seed)
+    for name, needed in BINARIES.items():
+        seed += 1
+        make_elf(os.path.join(path, name.lstrip('/')), needed, INTERP,
+                 size=lib_size * 256, seed=seed)
+    make_elf(os.path.join(path, 'usr/lib/gcc/x86_64-pc-linux-gnu/13',
+                          'libgcc_s.so.1'), ['libc.so.6'], size=128 * 1024)
+
+    os.makedirs(os.path.join(path, 'etc'))
+    with open(os.path.join(path, 'etc/localtime'), 'wb') as fobj:
+        fobj.write(b'TZif2' + bytes(1024))
+
+    src = os.path.join(path, 'usr/src', 'linux-' + KERNEL_VER)
+    os.makedirs(src)
+    os.symlink('linux-' + KERNEL_VER, os.path.join(path, 'usr/src/linux'))
+    with open(os.path.join(src, '.config'), 'w') as fobj:
+        fobj.write(''.join(f'{opt}=y\n' for opt in
+                           mkinitramfs.COMPRESSION.values() if opt))
+
+    moddir = os.path.join(path, 'lib/modules', KERNEL_VER)
+    deps = []
+    aliases = []
+    rnd = random.Random(seed)
+    for idx in range(modules):
+        rel = f'kernel/drivers/bench{idx % 16}/mod{idx}.ko'
+        make_elf(os.path.join(moddir, rel), size=module_size * 1024,
+                 seed=seed + idx)
+        # every module depends on the one with half of its index
+        line = f'{rel}:'
+        if idx:
+            line += f' kernel/drivers/bench{idx // 2 % 16}/mod{idx // 2}.ko'
+        deps.append(line + '\n')
+        aliases.append(f'alias bench:{rnd.randrange(1 << 16):04x}* '
+                       f'mod{idx}\n')
+    with open(os.path.join(moddir, 'modules.dep'), 'w') as fobj:
+        fobj.writelines(deps)
+    with open(os.path.join(moddir, 'modules.alias'), 'w') as fobj:
+        fobj.writelines(aliases)
+    with open(os.path.join(moddir, 'modules.builtin'), 'w') as fobj:
+        fobj.write('kernel/fs/ext4/ext4.ko\n')
+
+
+def build(conf, output):
+    """
+    Build the image in the fresh interpreter, so that the peak memory usage
+    is measured only for the build itself, not for the benchmark process.
+    """
+    params = json.dumps({'path': os.path.dirname(mkinitramfs.__file__),
+                         'conf': conf, 'output': output})
+    proc = subprocess.run([sys.executable, '-c', BUILD_SCRIPT], check=True,
+                          input=params, stdout=subprocess.PIPE, text=True)
+    return json.loads(proc.stdout)
+
+
+def decompress(path, method):
+    """
+    Return time of decompressing the image.
+    """
+    start = time.perf_counter()
+    if method in ('gzip', 'xz', 'none'):
+        opener = {'gzip': gzip.open, 'xz': lzma.open, 'none': open}[method]
+        with opener(path, 'rb') as fobj:
+            while fobj.read(mkinitramfs.CPIO_BUFSIZE):
+                pass
+    else:
+        subprocess.run([method, '-d', '-c', path], check=True,
+                       stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('-c', '--compression', action='append',
+                        choices=sorted(mkinitramfs.COMPRESSION),
+                        help='Compression method to benchmark, might be '
+                        'repeated. All available by default.')
+    parser.add_argument('-L', '--compression-level', type=int)
+    parser.add_argument('-T', '--compression-threads', type=int)
+    parser.add_argument('-m', '--modules', type=int, default=200,
+                        help='Number of fake kernel modules, 200 by default.')
+    parser.add_argument('--module-size', type=int, default=64,
+                        help='Size of every kernel module in kB, 64 by '
+                        'default.')
+    parser.add_argument('--lib-size', type=int, default=512,
+                        help='Size of every library in kB, 512 by default.')
+    parser.add_argument('--select-modules', action='append',
+                        help='Copy only selected modules (and their '
+                        'dependencies) instead of whole tree.')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='Number of runs for every method, best one is '
+                        'reported. 3 by default.')
+    parser.add_argument('-k', '--keep', action='store_true',
+                        help='Do not remove fake root and images.')
+    parser.add_argument('-j', '--json', metavar='FILE',
+                        help='Write the results to the JSON file.')
+    args = parser.parse_args()
+
+    methods = args.compression or [
+        m for m in sorted(mkinitramfs.COMPRESSION)
+        if m in ('gzip', 'none', 'xz') or shutil.which(m)]
+
+    tmpdir = tempfile.mkdtemp(prefix='mkinitramfs_bench_')
+    root = os.path.join(tmpdir, 'root')
+    make_root(root, args.modules, args.module_size, args.lib_size)
+    key = os.path.join(tmpdir, 'bench.key')
+    with open(key, 'wb') as fobj:
+        fobj.write(os.urandom(4096))
+
+    results = []
+    try:
+        for method in methods:
+            # arguments for mkinitramfs.Config in the build process
+            conf = ({'root': root,
+                     'key_path': key,
+                     'copy_modules': True,
+                     'modules': args.select_modules,
+                     'lvm': True,
+                     'yubikey': False,
+                     'compression': method,
+                     'compression_level': args.compression_level,
+                     'compression_threads': args.compression_threads},
+                    {'bench': {'uuid': 'bench'}}, 'bench')
+            output = os.path.join(tmpdir, f'initramfs-{method}.cpio')
+            runs = []
+            for _ in range(args.repeat):
+                run = build(conf, output)
+                run['unpack'] = decompress(output, method)
+                runs.append(run)
+            results.append({'method': method,
+                            'size': os.path.getsize(output),
+                            'build': min(r['build'] for r in runs),
+                            'cpu': min(r['cpu'] for r in runs),
+                            'rss': max(r['rss'] for r in runs),
+                            'unpack': min(r['unpack'] for r in runs)})
+    finally:
+        if args.keep:
+            sys.stderr.write(f'Fake root and images kept in {tmpdir}\n')
+        else:
+            shutil.rmtree(tmpdir)
+
+    sys.stdout.write(f'{"method":<8} {"build [s]":>10} {"cpu [s]":>9} '
+                     f'{"rss [kB]":>10} {"size [B]":>12} '
+                     f'{"unpack [s]":>11}\n')
+    for res in results:
+        sys.stdout.write(f'{res["method"]:<8} {res["build"]:>10.3f} '
+                         f'{res["cpu"]:>9.3f} {res["rss"]:>10} '
+                         f'{res["size"]:>12} {res["unpack"]:>11.3f}\n')
+
+    if args.json:
+        with open(args.json, 'w') as fobj:
+            json.dump({'time': time.time(),
+                       'params': {'modules': args.modules,
+                                  'module_size': args.module_size,
+                                  'lib_size': args.lib_size,
+                                  'select_modules': args.select_modules},
+                       'results': results}, fobj, indent=2)
+
+
+if __name__ == "__main__":
+    main()
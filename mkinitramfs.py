@@ -3,77 +3,104 @@
 Python initrd generating script
 """
 import argparse
+import collections
+import concurrent.futures
+import contextlib
+import ctypes
+import fcntl
+import fnmatch
+import functools
+import gzip
+import hashlib
+import io
+import json
+import lzma
 import os
+import re
+import runpy
+import select
+import shlex
 import shutil
+import stat
+import struct
 import subprocess
 import sys
 import tempfile
+import threading
+import time
 import tomllib
+import zlib
 
 
 XDG_CONFIG_HOME = os.getenv('XDG_CONFIG_HOME', os.path.expanduser('~/.config'))
 XDG_DATA_HOME = os.getenv('XDG_DATA_HOME',
                           os.path.expanduser('~/.local/share'))
+XDG_CACHE_HOME = os.getenv('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
 CONF_PATH = os.path.join(XDG_CONFIG_HOME, 'mkinitramfs.toml')
+CACHE_PATH = os.path.join(XDG_CACHE_HOME, 'mkinitramfs')
 KEYS_PATH = os.path.join(XDG_DATA_HOME, 'keys')
+BOOT_DIR = '/boot'
+BOOT_TIMINGS = '/run/initramfs-timings'
 ROOT_AK = '/root/.ssh/authorized_keys'
-SHEBANG = "#!/bin/bash\n"
 SHEBANG_ASH = "#!/bin/sh\n"
-DEPS = """
-DEPS=(
-/bin/busybox
-/usr/bin/ccrypt
-/sbin/cryptsetup
-%(lvm)s
-%(yubikey)s
-%(dropbear)s
-)
-"""
+DEPS = ('/bin/busybox', '/usr/bin/ccrypt', '/sbin/cryptsetup')
+LVM_DEPS = ('/sbin/lvscan', '/sbin/vgchange')
+YUBIKEY_DEPS = ('/usr/bin/ykchalresp',)
+DROPBEAR_DEPS = ('/usr/sbin/dropbear',)
+# commands available in rescue shell, beside those used by init, in minimal
+# mode
+RESCUE_COMMANDS = ('blkid', 'cat', 'clear', 'cp', 'dmesg', 'grep', 'kill',
+                   'less', 'ln', 'ls', 'lsmod', 'mkdir', 'modprobe', 'mount',
+                   'mv', 'ps', 'reboot', 'rm', 'sh', 'umount', 'vi')
+# words which might precede the command
+SHELL_KEYWORDS = ('!', 'do', 'done', 'elif', 'else', 'esac', 'exec', 'fi',
+                  'if', 'then', 'until', 'while', '{', '}')
 # /usr/sbin/dropbear
 # /usr/bin/dropbearkey
 # /usr/sbin/wpa_supplicant
-COPY_DEPS = """
-for bin in ${DEPS[*]}; do
-    cp $bin ./bin/
-    ldd $bin >/dev/null || continue
-    for lib in $(ldd $bin | sed -nre 's,.* (/.*lib.*/.*.so.*) .*,\\1,p' \\
-        -e 's,.*(/lib.*/ld.*.so.*) .*,\\1,p')
-    do
-        cp $lib lib64/
-    done
-done
-# extra lib for new version of cryptsetup, which need to do locks
-for path in $(find /usr/lib/gcc|grep libgcc_s.so.1); do
-    [ "$(basename $(dirname $path))" = '32' ] && continue
-    cp $path lib/
-done
-
-if %s; then
-    if [ ! -f ~/.cache/askpass ]; then
-        if ! wget "https://bitbucket.org/piotrkarbowski/better-initramfs/downloads/askpass.c"; then
-            if ! wget "https://raw.githubusercontent.com/gryf/mkinitramfs/refs/heads/master/askpass.c"; then
-                echo "Error: Unable to fetch the 'askpass.c'. Aborting" >&2
-                exit 1
-            fi
-        fi
-        gcc -Os -static askpass.c -o ~/.cache/askpass
-        rm askpass.c
-    fi
-    cp ~/.cache/askpass bin/
-fi
-"""
-COPY_MODULES = """
-KERNEL=$(readlink /usr/src/linux)
-VERSION=${KERNEL#linux-}
-mkdir -p lib/modules
-cp -a "/lib/modules/${VERSION}" lib/modules/
-rm -fr lib/modules/misc lib/modules/video
-"""
-MKCPIO = """
-find . -print0 | cpio --quiet --null -o -H newc | \\
-    gzip > %(arch)s
-exit $?
-"""
+# askpass.c is looked for next to the script and in the data directory
+ASKPASS_SOURCES = (os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                'askpass.c'),
+                   os.path.join(XDG_DATA_HOME, 'mkinitramfs', 'askpass.c'))
+ASKPASS_CFLAGS = ('-Os', '-static')
+# python scripts registering additional build stages
+PLUGINS_PATH = os.path.join(XDG_DATA_HOME, 'mkinitramfs', 'plugins')
+LD_SO_CACHE = '/etc/ld.so.cache'
+LD_SO_CACHE_MAGIC = b'glibc-ld.so.cache1.1'
+LIB_DIRS = ('/lib64', '/usr/lib64', '/lib', '/usr/lib')
+LIB_INDEX_PATH = os.path.join(CACHE_PATH, 'libindex.json')
+LIB_SCAN_DIRS = ('/usr/lib', '/lib64')
+# directories which are not worth to look for libraries in
+LIB_SCAN_PRUNE = ('debug', 'firmware', 'go', 'jvm', 'locale', 'modules',
+                  'node_modules', 'perl*', 'python*', 'ruby', 'systemd')
+ELF_MAGIC = b'\x7fELF'
+PT_LOAD, PT_DYNAMIC, PT_INTERP = 1, 2, 3
+DT_NULL, DT_NEEDED, DT_STRTAB, DT_RPATH, DT_RUNPATH = 0, 1, 5, 15, 29
+CPIO_MAGIC = b'070701'
+CPIO_TRAILER = 'TRAILER!!!'
+CPIO_BUFSIZE = 1024 * 1024
+GZIP_CHUNK = 1024 * 1024
+FICLONE = 0x40049409
+# number of compressed base layers kept in cache
+LAYERS_KEPT = 8
+# files up to this size are read while computing the key of cached layer,
+# bigger ones are identified by their size and mtime, which are the same in
+# every process sharing the base
+LAYER_KEY_READ = 64 * 1024
+# IN_ATTRIB, IN_CLOSE_WRITE, IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE
+INOTIFY_MASK = 0x3cc
+# seconds without any change, after which images are rebuilt in watch mode
+WATCH_DELAY = 2
+# options which don't affect the contents of the image
+WATCH_IGNORED = ('cache', 'copy_threads', 'install', 'kernels', 'manifest',
+                 'timings', 'timings_json')
+# supported compression methods along with kernel config option needed for
+# unpacking such initramfs
+COMPRESSION = {'gzip': 'CONFIG_RD_GZIP',
+               'lz4': 'CONFIG_RD_LZ4',
+               'none': None,
+               'xz': 'CONFIG_RD_XZ',
+               'zstd': 'CONFIG_RD_ZSTD'}
 
 INIT = """
 DEVICE=''
@@ -104,6 +131,65 @@ ln -s /dev/console /dev/tty
 
 """
 
+# wait up to given number of seconds until the command succeeds. Command is
+# run again when the list of block devices changes, and in between there is
+# a short sleep, growing up to half a second; once there, command is run on
+# every tick, as not everything it waits for shows up in /proc/partitions.
+WAIT_FOR = """
+uptime_cs() {
+    local up rest
+    read up rest < /proc/uptime
+    # leading 1 keeps the fraction (like 05) from being read as octal
+    echo $((${up%.*} * 100 + 1${up#*.} - 100))
+}
+
+wait_for() {
+    local deadline=$(($(uptime_cs) + $1 * 100)) delay=0.05 parts='' current
+    shift
+    while true; do
+        current=$(cat /proc/partitions)
+        if [ "${current}" != "${parts}" ]; then
+            parts=${current}
+            "$@" && return 0
+            delay=0.05
+        elif [ ${delay} = 0.5 ]; then
+            "$@" && return 0
+        fi
+        [ $(uptime_cs) -ge ${deadline} ] && return 1
+        sleep ${delay}
+        case ${delay} in
+            0.05) delay=0.1 ;;
+            0.1) delay=0.2 ;;
+            *) delay=0.5 ;;
+        esac
+    done
+}
+
+# find the device with the tag (like UUID or LABEL) set to the value, reading
+# the headers of all the block devices in one pass. Result is in FOUND.
+find_dev() {
+    FOUND=$(blkid | grep -i " $1=\\"$2\\"" | cut -d: -f1 | head -n 1)
+    [ -n "${FOUND}" ]
+}
+"""
+
+# optional: record the boot stages along with the time since kernel start
+# into the log, which is moved into the new root along with whole /run
+TRACE = """
+mount -t tmpfs -o nosuid,nodev,mode=755 run /run
+mkdir -p /run/cryptsetup /run/lock
+
+mark() {
+    local up rest
+    read up rest < /proc/uptime
+    echo "${up} $1" >> %(log)s
+}
+"""
+
+TRACE_MOVE = """
+[ -d /new-root/run ] && mount --move /run /new-root/run
+"""
+
 # check for 'rescue' keyword if there should be shell requested
 INIT_CMD = """
 CMD=`cat /proc/cmdline`
@@ -133,14 +219,7 @@ done
 #
 # be carefull, which disk you select to write.
 INIT_SD = """
-for counter in $(seq 5); do
-    $CLEAR
-    if [ -b /dev/mmcblk0p1 ]; then
-        KEYDEV=/dev/mmcblk0p1
-        break
-    fi
-    sleep 1
-done
+wait_for 5 [ -b /dev/mmcblk0p1 ] && KEYDEV=/dev/mmcblk0p1
 """
 
 # optional: search for the labeled device - assuming it will be usb stick with
@@ -152,35 +231,13 @@ done
 # note, that label will always be uppercase, so that case sensitiv check is
 # off.
 INIT_LABELED = """
-for counter in $(seq 3); do
-    $CLEAR
-    for dev in /dev/sd* /dev/mmcblk*; do
-        if blkid "${dev}" | grep -w LABEL | grep -iqw "%(label)s"; then
-            KEYDEV="${dev}"
-            break
-        fi
-    done
-    [ -n "${KEYDEV}" ] && break
-    sleep 1
-done
+wait_for 3 find_dev LABEL "%(label)s" && KEYDEV="${FOUND}"
 """
 
 # optional: dropbear script for mounting device. It will use key if present
 # and interactively prompt for password
 DROPBEAR_SCRIPT = """
-for counter in $(seq 3); do
-    $CLEAR
-    for dev in /dev/sd* /dev/nvme*; do
-        if cryptsetup isLuks ${dev}; then
-            if [ $(cryptsetup luksUUID ${dev}) = "${UUID}" ]; then
-                DEVICE=$dev
-                break
-            fi
-        fi
-    done
-    [ -n "${DEVICE}" ] && break
-    sleep 1
-done
+wait_for 3 find_dev UUID "${UUID}" && DEVICE="${FOUND}"
 
 if [ -z "${DEVICE}" ]; then
     echo "No LUKS device found to boot from! Giving up."
@@ -210,19 +267,7 @@ fi
 
 # Open encrypted fs
 INIT_OPEN = """
-for counter in $(seq 3); do
-    $CLEAR
-    for dev in /dev/sd* /dev/nvme*; do
-        if cryptsetup isLuks ${dev}; then
-            if [ $(cryptsetup luksUUID ${dev}) = "${UUID}" ]; then
-                DEVICE=$dev
-                break
-            fi
-        fi
-    done
-    [ -n "${DEVICE}" ] && break
-    sleep 1
-done
+wait_for 3 find_dev UUID "${UUID}" && DEVICE="${FOUND}"
 
 if [ -z "${DEVICE}" ]; then
     echo "No LUKS device found to boot from! Giving up."
@@ -285,6 +330,70 @@ if [ ! -b /dev/mapper/root ]; then
 fi
 """
 
+# optional: run all the unlock methods concurrently instead of one after
+# another. First one which opens the root device wins, the rest is killed.
+RACE = """
+PIDS=''
+RACERS=0
+rm -f /tmp/unlock-done
+
+race() {
+    RACERS=$((RACERS + 1))
+    ("$@"; echo >> /tmp/unlock-done) &
+    PIDS="${PIDS} $!"
+}
+
+unlock_keydev() {
+    dd if=${KEYDEV} skip=31337 count=8 2>/dev/null | \
+            cryptsetup open --allow-discards $DEVICE root
+}
+
+# gives up after the same number of attempts as the sequential unlock, so
+# that missing key doesn't stop the reboot
+unlock_yubikey() {
+    for i in 1 2 3 4 5 6; do
+        [ -b /dev/mapper/root ] && break
+        pass=$(ykchalresp %(disk)s 2>/dev/null)
+        if [ -n "$pass" ]; then
+            echo "$pass" | ccrypt -c -k - "$KEY.yk" | \
+                    cryptsetup open --allow-discards $DEVICE root
+            break
+        fi
+        sleep .5
+    done
+}
+
+unlock_password() {
+    for i in 0 1 2 ; do
+        ccrypt -c $KEY | cryptsetup open --allow-discards $DEVICE root
+        [ -b /dev/mapper/root ] && break
+    done
+}
+
+# root device is opened by decrypt.sh script run over ssh
+unlock_remote() {
+    while [ ! -b /dev/mapper/root ]; do
+        sleep .5
+    done
+}
+"""
+
+RACE_WAIT = """
+done=0
+while [ ! -b /dev/mapper/root ] && [ ${done} -lt ${RACERS} ]; do
+    sleep .1
+    [ -f /tmp/unlock-done ] && done=$(wc -l < /tmp/unlock-done)
+done
+kill ${PIDS} 2>/dev/null
+killall ccrypt ykchalresp 2>/dev/null
+stty sane 2>/dev/null
+
+if [ ! -b /dev/mapper/root ]; then
+    echo "Failed to open encrypted device. Rebooting in 5 seconds."
+    reboot -f -d 5
+fi
+"""
+
 SWROOT = """
 # get the tty back
 rm /dev/tty
@@ -294,33 +403,1474 @@ mount /dev/mapper/root /new-root
 
 # restore hotplug events
 echo > /proc/sys/kernel/hotplug
-
+%(trace)s
 umount -l /proc /sys /dev
 
 exec switch_root /new-root /sbin/init
 """
 
 
+class BuildError(Exception):
+    """
+    Error which stops the build. It is reported with the exit code of the
+    script once the build is cleaned up.
+    """
+    def __init__(self, code, message):
+        super().__init__(code, message)
+        self.code = code
+        self.message = message
+
+    def __str__(self):
+        return self.message.strip()
+
+
+def _host_path(root, path):
+    """
+    Return path placed within the root directory. Symlinks in the leading
+    directories are resolved within the root, last component is left as it
+    is, so that it might be still read as the link.
+    """
+    if root == '/':
+        return path
+    dirname, name = os.path.split(path.lstrip('/'))
+    return os.path.join(_host_realpath(root, os.path.join(root, dirname)),
+                        name)
+
+
+def _host_realpath(root, path):
+    """
+    Return path (on the host) with all the symlinks resolved, where absolute
+    link targets are relative to the root directory, the same way as they
+    would be seen after chroot(2). Paths outside of the root are returned
+    unchanged.
+    """
+    if root == '/':
+        return path
+    root = os.path.abspath(root)
+    rel = os.path.relpath(os.path.abspath(path), root)
+    if rel == '..' or rel.startswith('../'):
+        return path
+    parts = rel.split('/')
+    resolved = []
+    links = 0
+    while parts:
+        part = parts.pop(0)
+        if part in ('', '.'):
+            continue
+        if part == '..':
+            if resolved:
+                resolved.pop()
+            continue
+        current = os.path.join(root, *resolved, part)
+        # give up on loops, opening the path will report it
+        if not os.path.islink(current) or links == 40:
+            resolved.append(part)
+            continue
+        links += 1
+        target = os.readlink(current)
+        if target.startswith('/'):
+            resolved = []
+        parts = target.split('/') + parts
+    return os.path.join(root, *resolved)
+
+
+def _read_elf(path):
+    """
+    Return dictionary with the interpreter, DT_NEEDED and DT_RUNPATH/DT_RPATH
+    entries for the ELF file, or None, if file is not a dynamic ELF object.
+    """
+    try:
+        with open(path, 'rb') as fobj:
+            data = fobj.read()
+    except OSError:
+        return None
+
+    if data[:4] != ELF_MAGIC:
+        return None
+
+    is64 = data[4] == 2
+    endian = '<' if data[5] == 1 else '>'
+    if is64:
+        ehdr, phdr, dyn = 'HHIQQQIHHH', 'IIQQQQQQ', 'qQ'
+    else:
+        ehdr, phdr, dyn = 'HHIIIIIHHH', 'IIIIIIII', 'iI'
+
+    (_, machine, _, _, phoff, _, _, _, phentsize,
+     phnum) = struct.unpack_from(endian + ehdr, data, 16)
+
+    info = {'arch': (data[4], data[5], machine), 'interp': None,
+            'needed': [], 'rpath': [], 'runpath': []}
+    loads = []
+    dynamic = None
+    for idx in range(phnum):
+        fields = struct.unpack_from(endian + phdr, data,
+                                    phoff + idx * phentsize)
+        if is64:
+            p_type, _, p_offset, p_vaddr, _, p_filesz = fields[:6]
+        else:
+            p_type, p_offset, p_vaddr, _, p_filesz = fields[:5]
+
+        if p_type == PT_LOAD:
+            loads.append((p_vaddr, p_offset, p_filesz))
+        elif p_type == PT_DYNAMIC:
+            dynamic = (p_offset, p_filesz)
+        elif p_type == PT_INTERP:
+            info['interp'] = (data[p_offset:p_offset + p_filesz]
+                              .rstrip(b'\0').decode())
+
+    if not dynamic:
+        return info
+
+    entries = []
+    strtab = None
+    dynsize = struct.calcsize(endian + dyn)
+    for offset in range(dynamic[0], sum(dynamic), dynsize):
+        tag, val = struct.unpack_from(endian + dyn, data, offset)
+        if tag == DT_NULL:
+            break
+        if tag == DT_STRTAB:
+            strtab = val
+        elif tag in (DT_NEEDED, DT_RPATH, DT_RUNPATH):
+            entries.append((tag, val))
+
+    # DT_STRTAB holds virtual address, which need to be translated into the
+    # file offset using loadable segments
+    for vaddr, offset, size in loads:
+        if strtab is not None and vaddr <= strtab < vaddr + size:
+            strtab = strtab - vaddr + offset
+            break
+    else:
+        return info
+
+    for tag, val in entries:
+        start = strtab + val
+        string = data[start:data.index(b'\0', start)].decode()
+        if tag == DT_NEEDED:
+            info['needed'].append(string)
+        else:
+            info['rpath' if tag == DT_RPATH else 'runpath'].extend(
+                p for p in string.split(':') if p)
+    return info
+
+
+def _read_ld_cache(path=LD_SO_CACHE):
+    """
+    Read library name to paths mapping out of the glibc ld.so.cache file.
+    """
+    result = {}
+    try:
+        with open(path, 'rb') as fobj:
+            data = fobj.read()
+    except OSError:
+        return result
+
+    start = data.find(LD_SO_CACHE_MAGIC)
+    if start < 0:
+        return result
+
+    nlibs, = struct.unpack_from('<I', data, start + len(LD_SO_CACHE_MAGIC))
+    for idx in range(nlibs):
+        _, key, value, _, _ = struct.unpack_from('<iIIIQ', data,
+                                                 start + 48 + idx * 24)
+        name = data[start + key:data.index(b'\0', start + key)].decode()
+        lib = data[start + value:data.index(b'\0', start + value)].decode()
+        result.setdefault(name, []).append(lib)
+    return result
+
+
+class ElfDeps:
+    """
+    Resolve shared libraries needed by the set of binaries, same way as
+    dynamic loader would do, without executing anything.
+    """
+    def __init__(self, root='/'):
+        self.root = root
+        self._ld_cache = None
+        self._elf = {}
+        self.missing = {}
+
+    def _info(self, path):
+        if path not in self._elf:
+            self._elf[path] = _read_elf(_host_realpath(self.root, path))
+        return self._elf[path]
+
+    def _exists(self, path):
+        return os.path.exists(_host_realpath(self.root, path))
+
+    def _find(self, name, path, info):
+        if '/' in name:
+            name = _host_path(self.root, name)
+            return name if self._exists(name) else None
+
+        if self._ld_cache is None:
+            self._ld_cache = _read_ld_cache(_host_path(self.root,
+                                                       LD_SO_CACHE))
+
+        origin = os.path.dirname(os.path.abspath(path))
+        runpath = [] if info['runpath'] else list(info['rpath'])
+        runpath.extend(info['runpath'])
+        candidates = []
+        for dir_ in runpath:
+            if 'ORIGIN' in dir_:
+                dir_ = dir_.replace('${ORIGIN}', origin).replace('$ORIGIN',
+                                                                 origin)
+            else:
+                dir_ = _host_path(self.root, dir_)
+            candidates.append(os.path.join(dir_, name))
+        candidates.extend(_host_path(self.root, p)
+                          for p in self._ld_cache.get(name, []))
+        candidates.extend(os.path.join(_host_path(self.root, d), name)
+                          for d in LIB_DIRS)
+
+        for candidate in candidates:
+            if not self._exists(candidate):
+                continue
+            lib = self._info(candidate)
+            # skip libraries for other architectures, like 32bit ones
+            if lib and lib['arch'] == info['arch']:
+                return candidate
+        return None
+
+    def resolve(self, binaries):
+        """
+        Return list of library paths being the transitive closure of the
+        dependencies for provided binaries. Every library is listed once.
+        """
+        libs = {}
+        queue = list(binaries)
+        while queue:
+            path = queue.pop(0)
+            info = self._info(path)
+            if not info:
+                continue
+
+            needed = list(info['needed'])
+            if info['interp']:
+                needed.insert(0, info['interp'])
+
+            for name in needed:
+                # all the libraries lands in the same directory, so there is
+                # no point to resolve the same name twice
+                soname = os.path.basename(name)
+                if soname in libs:
+                    continue
+                lib = self._find(name, path, info)
+                if not lib:
+                    self.missing.setdefault(soname, path)
+                    continue
+                libs[soname] = lib
+                queue.append(lib)
+        return list(libs.values())
+
+
+def _copy_file(src, dest):
+    """
+    Copy src file to dest along with its mode and mtime. Hardlink is tried
+    first, than reflink and copy_file_range(2), before falling back to the
+    regular copy. Returns the method which was used.
+    """
+    try:
+        os.link(src, dest)
+        return 'hardlink'
+    except OSError:
+        pass
+
+    with open(src, 'rb') as fsrc, open(dest, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            method = 'reflink'
+        except OSError:
+            method = 'copy_file_range'
+            try:
+                remaining = os.fstat(fsrc.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(),
+                                                remaining)
+                    if not copied:
+                        break
+                    remaining -= copied
+            except OSError:
+                method = 'copy'
+                fsrc.seek(0)
+                fdst.seek(0)
+                fdst.truncate()
+                shutil.copyfileobj(fsrc, fdst, CPIO_BUFSIZE)
+    shutil.copystat(src, dest)
+    return method
+
+
+def _link_or_copy(src, dest):
+    """
+    Hardlink src file as dest, or copy it, if filesystem doesn't support
+    hardlinks. Dest is synced to the disk.
+    """
+    if os.path.lexists(dest):
+        os.unlink(dest)
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copy2(src, dest)
+        with open(dest, 'rb') as fobj:
+            os.fsync(fobj.fileno())
+
+
+def _replace_symlink(target, path):
+    """
+    Atomically point symlink path to the target by renaming staged link.
+    """
+    tmp = f'{path}.tmp'
+    if os.path.lexists(tmp):
+        os.unlink(tmp)
+    os.symlink(target, tmp)
+    os.replace(tmp, path)
+
+
+def _fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _source_date():
+    """
+    Return the time, which all the mtimes in the archive are clamped to.
+    """
+    return int(os.environ.get('SOURCE_DATE_EPOCH', 0))
+
+
+def _file_hash(path):
+    with open(path, 'rb') as fobj:
+        return hashlib.file_digest(fobj, 'sha256').hexdigest()
+
+
+class LibIndex:
+    """
+    Persistent index of the shared libraries, keyed by the file name stripped
+    from the version and extension (like "libgcc_s"). It is built out of the
+    ld.so.cache and a scan of LIB_SCAN_DIRS, and stored in the cache
+    directory along with directories mtimes, so that on the subsequent runs
+    only the changed directories are read again.
+    """
+    def __init__(self, roots=LIB_SCAN_DIRS, path=None, root='/'):
+        self.root = root
+        self.roots = [_host_path(root, r) for r in roots]
+        self.path = path or LIB_INDEX_PATH
+        if not path and root != '/':
+            # keep separate index for every alternative root
+            digest = hashlib.sha256(root.encode()).hexdigest()[:12]
+            self.path = os.path.join(CACHE_PATH, f'libindex-{digest}.json')
+        self._dirs = {}
+        self._libs = None
+
+    def _load(self):
+        try:
+            with open(self.path) as fobj:
+                data = json.load(fobj)
+        except (OSError, ValueError):
+            return {}
+        if data.get('roots') != self.roots:
+            return {}
+        return data.get('dirs', {})
+
+    def _save(self):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            _fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path))
+            with open(_fd, 'w') as fobj:
+                json.dump({'roots': self.roots, 'dirs': self._dirs}, fobj)
+            os.replace(tmp, self.path)
+        except OSError:
+            pass
+
+    def _scan(self, cached):
+        changed = False
+        stack = list(self.roots)
+        while stack:
+            path = stack.pop()
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except OSError:
+                continue
+
+            entry = cached.get(path)
+            if not entry or entry[0] != mtime:
+                changed = True
+                entry = [mtime, [], []]
+                try:
+                    with os.scandir(path) as items:
+                        for item in items:
+                            if item.is_dir():
+                                if not (item.is_symlink() or
+                                        any(fnmatch.fnmatch(item.name, pat)
+                                            for pat in LIB_SCAN_PRUNE)):
+                                    entry[2].append(item.name)
+                            elif '.so' in item.name:
+                                entry[1].append(item.name)
+                except OSError:
+                    pass
+            self._dirs[path] = entry
+            stack.extend(os.path.join(path, d) for d in entry[2])
+        return changed or set(cached) != set(self._dirs)
+
+    def _build(self):
+        if self._scan(self._load()):
+            self._save()
+
+        self._libs = {}
+        for path, (_, fnames, _) in self._dirs.items():
+            for fname in fnames:
+                self._libs.setdefault(fname.split('.')[0],
+                                      set()).add(os.path.join(path, fname))
+        ld_cache = _read_ld_cache(_host_path(self.root, LD_SO_CACHE))
+        for name, paths in ld_cache.items():
+            self._libs.setdefault(name.split('.')[0], set()).update(
+                _host_path(self.root, p) for p in paths)
+
+    def find(self, name, root='/'):
+        """
+        Return sorted list of paths for the libraries named name, which are
+        placed under the root directory.
+        """
+        if self._libs is None:
+            self._build()
+        root = os.path.join(_host_path(self.root, root), '')
+        return sorted(p for p in self._libs.get(name, ())
+                      if p.startswith(root))
+
+
+class KernelModules:
+    """
+    Select kernel modules along with all their dependencies using depmod
+    generated files (modules.dep, modules.alias and friends).
+    """
+    def __init__(self, path):
+        self.path = path
+        self.deps = {}
+        self.aliases = []
+        self.softdeps = {}
+        self.builtin = set()
+        self.missing = []
+        self._load()
+
+    @staticmethod
+    def name(path):
+        return os.path.basename(path).split('.ko')[0].replace('-', '_')
+
+    def _lines(self, fname):
+        try:
+            with open(os.path.join(self.path, fname)) as fobj:
+                return [line.split() for line in fobj
+                        if line.strip() and not line.startswith('#')]
+        except OSError:
+            return []
+
+    def _load(self):
+        for fields in self._lines('modules.dep'):
+            self.deps[self.name(fields[0][:-1])] = (
+                fields[0][:-1], [self.name(dep) for dep in fields[1:]])
+        for fields in self._lines('modules.alias'):
+            self.aliases.append((fields[1], self.name(fields[2])))
+        for fields in self._lines('modules.softdep'):
+            self.softdeps[self.name(fields[1])] = [
+                self.name(f) for f in fields[2:] if f not in ('pre:', 'post:')]
+        for fields in self._lines('modules.builtin'):
+            self.builtin.add(self.name(fields[0]))
+
+    def _loaded(self):
+        try:
+            with open('/proc/modules') as fobj:
+                return [line.split()[0] for line in fobj]
+        except OSError:
+            return []
+
+    def resolve(self, spec):
+        """
+        Return set of module names for the provided list of module names,
+        aliases or the "loaded" keyword, which stands for currently loaded
+        modules, including all their dependencies.
+        """
+        queue = []
+        for item in spec:
+            if item == 'loaded':
+                queue.extend(self._loaded())
+                continue
+            name = item.replace('-', '_')
+            if name in self.deps:
+                queue.append(name)
+                continue
+            matched = [mod for pattern, mod in self.aliases
+                       if fnmatch.fnmatchcase(item, pattern)]
+            if matched:
+                queue.extend(matched)
+            elif name not in self.builtin:
+                self.missing.append(item)
+
+        selected = set()
+        while queue:
+            name = queue.pop()
+            if name in selected or name not in self.deps:
+                continue
+            selected.add(name)
+            queue.extend(self.deps[name][1])
+            queue.extend(self.softdeps.get(name, []))
+        return selected
+
+    def trimmed(self, fname, selected):
+        """
+        Return contents of the depmod file fname limited to the lines
+        concerning selected modules.
+        """
+        result = []
+        for fields in self._lines(fname):
+            if fname == 'modules.dep':
+                name = self.name(fields[0][:-1])
+            elif fname == 'modules.softdep':
+                name = self.name(fields[1])
+            elif fname == 'modules.order':
+                name = self.name(fields[0])
+            else:
+                name = self.name(fields[-1])
+            if name in selected:
+                result.append(' '.join(fields) + '\n')
+        return ''.join(result)
+
+
+class CpioWriter:
+    """
+    Streaming writer for the cpio "newc" format, as expected by the kernel
+    initramfs unpacker. All the entries are owned by root, and their mtimes
+    are clamped to mtime, so that the same input gives the same archive.
+    """
+    def __init__(self, fobj, bufsize=CPIO_BUFSIZE, mtime=0):
+        self.fobj = fobj
+        self.mtime = mtime
+        self.offset = 0
+        self._ino = 0
+        self.entries = 0
+        self._buf = bytearray(bufsize)
+        # sendfile(2) is only usable, when data goes straight to the file
+        self._sendfile = isinstance(fobj, (io.FileIO, io.BufferedWriter))
+
+    def _write(self, data):
+        self.fobj.write(data)
+        self.offset += len(data)
+
+    def _pad(self, size=4):
+        if self.offset % size:
+            self._write(b'\0' * (size - self.offset % size))
+
+    def _header(self, name, ino, mode, nlink, mtime, size, uid=0, gid=0,
+                rdev=0):
+        name = name.encode() + b'\0'
+        fields = (ino, mode, uid, gid, nlink, mtime, size, 0, 0,
+                  os.major(rdev), os.minor(rdev), len(name), 0)
+        self._write(CPIO_MAGIC + b''.join(b'%08X' % f for f in fields) +
+                    name)
+        self._pad()
+
+    def _copy_data(self, path, size):
+        with open(path, 'rb') as src:
+            if self._sendfile:
+                self.fobj.flush()
+                remaining = size
+                while remaining:
+                    sent = os.sendfile(self.fobj.fileno(), src.fileno(),
+                                       None, remaining)
+                    if not sent:
+                        break
+                    remaining -= sent
+                self.offset += size - remaining
+            else:
+                view = memoryview(self._buf)
+                remaining = size
+                while remaining:
+                    read = src.readinto(view[:min(remaining, len(view))])
+                    if not read:
+                        break
+                    self._write(view[:read])
+                    remaining -= read
+        if remaining:
+            raise OSError(f'{path} has been truncated while archiving')
+        self._pad()
+
+    def add(self, name, st, path=None, nlink=1, ino=None):
+        """
+        Write entry for the file described by the stat result st. Regular
+        file contents are read from path, hardlinks which are not carrying
+        the data should be passed with path set to None.
+        """
+        if ino is None:
+            self._ino += 1
+            ino = self._ino
+        self.entries += 1
+
+        size = 0
+        data = None
+        if stat.S_ISLNK(st.st_mode):
+            data = os.readlink(path).encode()
+            size = len(data)
+        elif stat.S_ISREG(st.st_mode) and path:
+            size = st.st_size
+
+        self._header(name, ino, st.st_mode, nlink,
+                     min(int(st.st_mtime), self.mtime), size,
+                     rdev=st.st_rdev)
+        if data is not None:
+            self._write(data)
+            self._pad()
+        elif size:
+            self._copy_data(path, size)
+
+    def add_tree(self, path, select=None):
+        """
+        Archive the contents of the directory path in the sorted order, so
+        that parent directories are always written before their contents.
+        If select function is provided, only entries for which it returns
+        True are archived.
+        """
+        self.add_trees([(path, select)])
+
+    def add_manifest(self, manifest, select=None):
+        """
+        Archive entries from the manifest, which maps paths in the archive
+        to the (kind, value, mode) tuples, where kind is one of "dir",
+        "file" (value is the source path), "data" (value holds the contents),
+        "symlink" (value is the link target) or "hardlink" (value is the path
+        of the "file" entry in the archive). If select function is provided,
+        only entries for which it returns True are archived.
+        """
+        self.add_trees([(manifest, select)])
+
+    def add_trees(self, trees):
+        """
+        Archive several (tree, select) pairs, where tree is either the
+        directory path or the manifest, as the single sorted stream, just
+        like they were merged into one tree. Entries from the later trees
+        take precedence over the same names from the earlier ones.
+        """
+        entries = {}
+        for tree, select in trees:
+            if isinstance(tree, dict):
+                entries.update((name, (tree, entry))
+                               for name, entry in tree.items()
+                               if not select or select(name))
+                continue
+            for root, dirs, files in os.walk(tree):
+                for fname in dirs + files:
+                    full = os.path.join(root, fname)
+                    name = os.path.relpath(full, tree)
+                    if not select or select(name):
+                        entries[name] = (None, (full, os.lstat(full)))
+
+        # hardlinked files are stored as a group of entries sharing the inode
+        # number, where only the last one carries the data, just like GNU
+        # cpio does.
+        links = {}
+        for name, (manifest, entry) in entries.items():
+            if manifest is None:
+                st = entry[1]
+                if stat.S_ISREG(st.st_mode) and st.st_nlink > 1:
+                    links.setdefault((st.st_dev, st.st_ino), []).append(name)
+            elif entry[0] == 'hardlink':
+                target = entry[1]
+                group = links.setdefault((id(manifest), target), [])
+                if not group and entries.get(target, (None,))[0] is manifest:
+                    group.append(target)
+                group.append(name)
+        groups = {}
+        for key, group in links.items():
+            group.sort()
+            groups.update((name, key) for name in group)
+
+        inodes = {}
+        for name, (manifest, entry) in sorted(entries.items(),
+                                              key=lambda item: item[0]):
+            key = groups.get(name)
+            if key:
+                group = links[key]
+                if key not in inodes:
+                    self._ino += 1
+                    inodes[key] = self._ino
+                path = entry[0] if manifest is None else manifest[key[1]][1]
+                self.add(name, entry[1] if manifest is None else
+                         os.stat(path), path if name == group[-1] else None,
+                         nlink=len(group), ino=inodes[key])
+                continue
+            if manifest is None:
+                self.add(name, entry[1], entry[0])
+                continue
+            kind, value, mode = entry
+            if kind == 'file':
+                self.add(name, os.stat(value), value)
+                continue
+
+            self._ino += 1
+            self.entries += 1
+            if kind == 'dir':
+                self._header(name, self._ino, stat.S_IFDIR | mode, 1,
+                             self.mtime, 0)
+                continue
+            data = value if kind == 'data' else value.encode()
+            mode |= stat.S_IFREG if kind == 'data' else stat.S_IFLNK
+            self._header(name, self._ino, mode, 1, self.mtime, len(data))
+            self._write(data)
+            self._pad()
+
+    def close(self):
+        self._header(CPIO_TRAILER, 0, 0, 1, 0, 0)
+        self._pad(512)
+        self.fobj.flush()
+
+
+class _HashSink:
+    """
+    File like object, which only computes the sha256 of the written data.
+    """
+    def __init__(self):
+        self.digest = hashlib.sha256()
+
+    def write(self, data):
+        self.digest.update(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+class _LayerKey(CpioWriter):
+    """
+    Writer computing the key of the layer out of the archive, where bigger
+    files are represented by their mtime instead of the contents (size is
+    in the header already), so that they don't have to be read.
+    """
+    def __init__(self, mtime=0):
+        super().__init__(_HashSink(), mtime=mtime)
+
+    def _copy_data(self, path, size):
+        if size <= LAYER_KEY_READ:
+            super()._copy_data(path, size)
+            return
+        self._write(b'%d' % os.stat(path).st_mtime_ns)
+        self._pad()
+
+    def hexdigest(self):
+        return self.fobj.digest.hexdigest()
+
+
+class _Source:
+    """
+    Raw image file, which allows to give back the data read too far.
+    """
+    def __init__(self, fobj):
+        self.fobj = fobj
+        self._pending = b''
+
+    def read(self, size):
+        data, self._pending = self._pending[:size], self._pending[size:]
+        if len(data) < size:
+            data += self.fobj.read(size - len(data))
+        return data
+
+    def unread(self, data):
+        self._pending = data + self._pending
+
+
+class _Decompressed:
+    """
+    Single compressed segment of the image, decompressed on the fly. Data
+    following the compressed stream is given back to the source.
+    """
+    def __init__(self, source, method):
+        self.source = source
+        self.method = method
+        if method == 'gzip':
+            self._decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            self._decomp = lzma.LZMADecompressor()
+        self._buf = bytearray()
+
+    def _decompress(self):
+        if self.method == 'gzip':
+            data = self._decomp.unconsumed_tail or \
+                self.source.read(CPIO_BUFSIZE)
+        else:
+            data = self.source.read(CPIO_BUFSIZE) \
+                if self._decomp.needs_input else b''
+        if not data and (self.method == 'gzip' or self._decomp.needs_input):
+            raise OSError(f'truncated {self.method} stream')
+        self._buf += self._decomp.decompress(data, CPIO_BUFSIZE)
+        if self._decomp.eof:
+            self.source.unread(self._decomp.unused_data)
+
+    def read(self, size):
+        while len(self._buf) < size and not self._decomp.eof:
+            self._decompress()
+        data = bytes(self._buf[:size])
+        del self._buf[:size]
+        return data
+
+
+class _Piped:
+    """
+    Compressed image decompressed by the external command. Command consumes
+    all the remaining data, so it have to be the last segment.
+    """
+    def __init__(self, source, method):
+        self._proc = subprocess.Popen([method, '-d', '-c', '-q'],
+                                      stdin=subprocess.PIPE,
+                                      stdout=subprocess.PIPE)
+        self._feeder = concurrent.futures.ThreadPoolExecutor(1)
+        self._feeder.submit(self._feed, source)
+
+    def _feed(self, source):
+        with self._proc.stdin:
+            while data := source.read(CPIO_BUFSIZE):
+                try:
+                    self._proc.stdin.write(data)
+                except BrokenPipeError:
+                    break
+
+    def read(self, size):
+        return self._proc.stdout.read(size)
+
+    def close(self):
+        self._proc.stdout.close()
+        self._proc.wait()
+        self._feeder.shutdown()
+
+
+class CpioReader:
+    """
+    Streaming reader for the initramfs images. Image might consist of
+    several concatenated cpio "newc" archives, each of them either
+    uncompressed or compressed using different method, as kernel accepts.
+    Contents of the files are only hashed, so memory usage doesn't depend on
+    the size of the image.
+    """
+    magics = ((b'\x1f\x8b', 'gzip'), (b'\xfd7zXZ\x00', 'xz'),
+              (b'\x28\xb5\x2f\xfd', 'zstd'), (b'\x02\x21\x4c\x18', 'lz4'),
+              (CPIO_MAGIC, 'none'))
+
+    def __init__(self, fobj):
+        self._source = _Source(fobj)
+        self.segments = []
+
+    def _segment(self):
+        """
+        Return stream for the next segment, or None at the end of the image.
+        """
+        if not self._skip_padding(self._source):
+            return None
+
+        head = self._source.read(6)
+        self._source.unread(head)
+        for magic, method in self.magics:
+            if head.startswith(magic):
+                break
+        else:
+            raise ValueError(f'unknown data in the image: {head!r}')
+        self.segments.append(method)
+        if method == 'none':
+            return self._source
+        if method in ('gzip', 'xz'):
+            return _Source(_Decompressed(self._source, method))
+        return _Source(_Piped(self._source, method))
+
+    @staticmethod
+    def _skip_padding(stream):
+        """
+        Skip zeros between the archives. Returns False at the end of stream.
+        """
+        while True:
+            data = stream.read(CPIO_BUFSIZE)
+            if not data:
+                return False
+            stripped = data.lstrip(b'\0')
+            if stripped:
+                stream.unread(stripped)
+                return True
+
+    @staticmethod
+    def _read(stream, size):
+        data = stream.read(size)
+        if len(data) != size:
+            raise ValueError('truncated cpio archive')
+        return data
+
+    def _archive(self, stream):
+        offset = 0
+        while True:
+            header = self._read(stream, 110)
+            if header[:6] != CPIO_MAGIC:
+                raise ValueError(f'bad cpio header: {header[:6]!r}')
+            (ino, mode, uid, gid, nlink, mtime, size, _, _, _, _, namesize,
+             _) = (int(header[6 + 8 * i:14 + 8 * i], 16) for i in range(13))
+            offset += 110 + namesize
+            name = self._read(stream, namesize)[:-1].decode()
+            self._read(stream, -offset % 4)
+            offset += -offset % 4
+            if name == CPIO_TRAILER:
+                return
+
+            entry = {'name': name, 'mode': mode, 'uid': uid, 'gid': gid,
+                     'nlink': nlink, 'mtime': mtime, 'size': size,
+                     'ino': ino}
+            if stat.S_ISLNK(mode):
+                entry['target'] = self._read(stream, size).decode()
+            elif stat.S_ISREG(mode):
+                digest = hashlib.sha256()
+                remaining = size
+                while remaining:
+                    data = self._read(stream, min(remaining, CPIO_BUFSIZE))
+                    digest.update(data)
+                    remaining -= len(data)
+                entry['sha256'] = digest.hexdigest()
+            offset += size
+            self._read(stream, -offset % 4)
+            offset += -offset % 4
+            yield entry
+
+    def _entries(self, stream):
+        """
+        Yield entries of the single archive. All the hardlinks are yielded
+        along with the last one, which carries the data.
+        """
+        links = {}
+        for entry in self._archive(stream):
+            if not stat.S_ISREG(entry['mode']) or entry['nlink'] < 2:
+                yield entry
+                continue
+            group = links.setdefault(entry['ino'], [])
+            group.append(entry)
+            if entry['size'] or len(group) == entry['nlink']:
+                for link in links.pop(entry['ino']):
+                    link['size'] = entry['size']
+                    link['sha256'] = entry['sha256']
+                    yield link
+        for group in links.values():
+            yield from group
+
+    def __iter__(self):
+        """
+        Yield dicts describing entries of the image. Entries might repeat, if
+        image consists of several archives, the later one wins.
+        """
+        while (stream := self._segment()) is not None:
+            try:
+                yield from self._entries(stream)
+                # decompressed stream might hold several archives too
+                while (stream is not self._source and
+                       self._skip_padding(stream)):
+                    yield from self._entries(stream)
+            finally:
+                if isinstance(stream.fobj, _Piped):
+                    stream.fobj.close()
+
+
+class ParallelGzip:
+    """
+    Gzip compressor, which splits the input into chunks compressed by the
+    pool of threads, the same way as pigz does. Every chunk is primed with
+    the last 32kB of preceding one, so that the output is a single, regular
+    gzip stream.
+    """
+    def __init__(self, fobj, level=6, threads=None):
+        self.fobj = fobj
+        self.level = level
+        threads = threads or os.cpu_count()
+        self._pool = concurrent.futures.ThreadPoolExecutor(threads)
+        self._pending = collections.deque()
+        self._max_pending = 2 * threads
+        self._buf = bytearray()
+        self._dict = b''
+        self._crc = 0
+        self._size = 0
+        # no file name, mtime set to 0 and unix as an OS
+        self.fobj.write(b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\x03')
+
+    def _compress(self, data, zdict, last):
+        args = (self.level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        comp = zlib.compressobj(*args, zdict=zdict) if zdict else \
+            zlib.compressobj(*args)
+        return comp.compress(data) + comp.flush(zlib.Z_FINISH if last else
+                                                zlib.Z_SYNC_FLUSH)
+
+    def _submit(self, data, last=False):
+        self._crc = zlib.crc32(data, self._crc)
+        self._size += len(data)
+        self._pending.append(self._pool.submit(self._compress, data,
+                                               self._dict, last))
+        self._dict = data[-32768:]
+        while len(self._pending) > self._max_pending:
+            self.fobj.write(self._pending.popleft().result())
+
+    def write(self, data):
+        self._buf += data
+        while len(self._buf) >= GZIP_CHUNK:
+            self._submit(bytes(self._buf[:GZIP_CHUNK]))
+            del self._buf[:GZIP_CHUNK]
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self._submit(bytes(self._buf), last=True)
+        self._buf = bytearray()
+        while self._pending:
+            self.fobj.write(self._pending.popleft().result())
+        self._pool.shutdown()
+        self.fobj.write(struct.pack('<II', self._crc,
+                                    self._size & 0xffffffff))
+        self.fobj.flush()
+
+
+@functools.lru_cache()
+def _xz_version(tool):
+    """
+    Return version of the xz tool as a tuple of numbers, or empty tuple if
+    it cannot be told.
+    """
+    try:
+        output = subprocess.run([tool, '--version'], capture_output=True,
+                                 text=True).stdout
+    except OSError:
+        return ()
+    match = re.search(r'(\d+)\.(\d+)\.(\d+)', output)
+    return tuple(int(num) for num in match.groups()) if match else ()
+
+
+class Compressor:
+    """
+    Context manager returning file object, which compress everything written
+    to it into the fobj using selected method.
+    """
+    def __init__(self, fobj, method='gzip', level=None, threads=None):
+        self.fobj = fobj
+        self.method = method
+        self.level = level
+        self.threads = threads or os.cpu_count()
+        self._proc = None
+        self._stream = None
+
+    def command(self):
+        """
+        Return command for the external compressor or None, if compression
+        is done within python.
+        """
+        if self.method in ('none', 'gzip'):
+            return None
+        tool = shutil.which(self.method)
+        if not tool:
+            return None
+
+        cmd = {'lz4': [tool, '-c', '-q', '-l'],
+               # multithreaded mode is forced to get the same output for
+               # any number of threads, which is possible since xz 5.4
+               'xz': [tool, '-c', '-q', '--check=crc32',
+                      f'-T+{self.threads}' if _xz_version(tool) >= (5, 4)
+                      else f'-T{self.threads}'],
+               'zstd': [tool, '-c', '-q', f'-T{self.threads}']}[self.method]
+        if self.level is not None:
+            if self.method == 'zstd' and self.level > 19:
+                cmd.append('--ultra')
+            cmd.append(f'-{self.level}')
+        return cmd
+
+    def __enter__(self):
+        if self.method == 'none':
+            self._stream = self.fobj
+        elif self.method == 'gzip':
+            # chunks are the same regardless of number of threads, so is the
+            # output
+            level = 6 if self.level is None else self.level
+            self._stream = ParallelGzip(self.fobj, level, self.threads)
+        elif self.method == 'xz' and not self.command():
+            # there is no xz command, use single threaded lzma module
+            self._stream = lzma.LZMAFile(self.fobj, 'wb',
+                                         format=lzma.FORMAT_XZ,
+                                         check=lzma.CHECK_CRC32,
+                                         preset=self.level)
+        else:
+            self.fobj.flush()
+            self._proc = subprocess.Popen(self.command(),
+                                          stdin=subprocess.PIPE,
+                                          stdout=self.fobj)
+            self._stream = self._proc.stdin
+        return self._stream
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self._stream is not self.fobj:
+            self._stream.close()
+        if self._proc and self._proc.wait() and not exc_type:
+            raise OSError(f'{self.method} exited with code '
+                          f'{self._proc.returncode}')
+        self.fobj.flush()
+
+
+def _script_commands(script):
+    """
+    Return names of the commands the shell script might run. It's a rough
+    scan rather than parsing: first words of every command are collected,
+    leaving out keywords, assignments, redirections and functions defined
+    in the script.
+    """
+    functions = set(re.findall(r'^(\w+)\(\)', script, re.M))
+    assigned = dict(re.findall(r'^(\w+)=(\w+)$', script, re.M))
+    script = re.sub(r'\$\(\(.*?\)\)', '', script)
+    script = re.sub(r'(^|\s)#.*', '', script, flags=re.M)
+
+    commands = set()
+    for command in re.split(r'[\n;&|()`]', script):
+        words = command.split()
+        while words and (words[0] in SHELL_KEYWORDS or
+                         re.match(r'\w+=|\d*[<>]', words[0])):
+            words.pop(0)
+        if not words or words[0] in ('case', 'for'):
+            continue
+        name = words[0]
+        var = re.fullmatch(r'\$\{?(\w+)\}?', name)
+        if var:
+            name = assigned.get(var.group(1), '')
+        name = os.path.basename(name)
+        if re.fullmatch(r'[a-zA-Z_\[][\w.\[-]*', name) and \
+                name not in functions:
+            commands.add(name)
+    return commands
+
+
+def _default_kernel(root='/'):
+    """
+    Return version of the kernel /usr/src/linux link points to, or None if
+    there is no such link.
+    """
+    try:
+        return os.path.basename(os.readlink(_host_path(
+            root, '/usr/src/linux'))).replace('linux-', '')
+    except OSError:
+        return None
+
+
+def _kernel_versions(conf):
+    """
+    Return list of kernel versions the images should be built for. Without
+    kernels option it's the one /usr/src/linux points to, and "all" means
+    every kernel with modules installed in /lib/modules.
+    """
+    modules = _host_path(conf.root, '/lib/modules')
+    if not conf.kernels:
+        versions = [_default_kernel(conf.root)]
+        if versions[0] is None:
+            raise BuildError(17, 'Cannot determine kernel version, '
+                             '/usr/src/linux link is missing.\n')
+        return versions
+
+    if 'all' in conf.kernels:
+        try:
+            versions = sorted(fname for fname in os.listdir(modules)
+                              if os.path.isdir(os.path.join(modules, fname)))
+        except OSError:
+            versions = []
+        if not versions:
+            raise BuildError(17, f'Cannot find any kernel in {modules}.\n')
+        return versions
+
+    for version in conf.kernels:
+        if not os.path.isdir(os.path.join(modules, version)):
+            raise BuildError(17, f'Cannot find kernel {version} in '
+                             f'{modules}.\n')
+    return list(dict.fromkeys(conf.kernels))
+
+
+def _make_boot_links(path, kernel_ver, keep=()):
+    """
+    Install the image on /boot, keeping the previous one as an .old.
+    Every file and link is staged under temporary name and renamed over
+    the target, so that initramfs link is valid at any time. Images named
+    in keep are not removed, even if the link pointed to them.
+    """
+    link = os.path.join(BOOT_DIR, 'initramfs')
+    old_link = os.path.join(BOOT_DIR, 'initramfs.old')
+    image = 'initramfs-' + kernel_ver
+
+    # link has to point to the image for that kernel too, since images for
+    # different kernels are often the same
+    if (os.path.islink(link) and os.readlink(link) == image and
+            os.path.isfile(link) and _file_hash(link) == _file_hash(path)):
+        os.unlink(path)
+        sys.stdout.write('Installed image is up to date.\n')
+        return
+
+    current = os.readlink(link) if os.path.islink(link) else None
+    tmp = os.path.join(BOOT_DIR, '.initramfs.old.tmp')
+    staged = [path, tmp, f'{link}.tmp', f'{old_link}.tmp']
+    try:
+        if current and os.path.exists(os.path.join(BOOT_DIR, current)):
+            old = None
+            if os.path.islink(old_link):
+                old = os.readlink(old_link)
+            _link_or_copy(os.path.join(BOOT_DIR, current), tmp)
+            os.replace(tmp, os.path.join(BOOT_DIR, current + '.old'))
+            _replace_symlink(current + '.old', old_link)
+            if old and old != current + '.old':
+                old = os.path.join(BOOT_DIR, old)
+                if os.path.lexists(old):
+                    os.unlink(old)
+
+        os.replace(path, os.path.join(BOOT_DIR, image))
+        _replace_symlink(image, link)
+        # link might have been dangling, so there is nothing to remove
+        if current and current != image and current not in keep and \
+                os.path.lexists(os.path.join(BOOT_DIR, current)):
+            os.unlink(os.path.join(BOOT_DIR, current))
+        _fsync_dir(BOOT_DIR)
+    except OSError as exc:
+        for fname in staged:
+            if os.path.lexists(fname):
+                os.unlink(fname)
+        raise BuildError(13, f'Error: Installing image failed: {exc}\n')
+
+
+def _install_image(path, kernel_ver):
+    """
+    Install the image as initramfs-<version> on /boot, leaving initramfs
+    links untouched.
+    """
+    image = os.path.join(BOOT_DIR, 'initramfs-' + kernel_ver)
+    if os.path.isfile(image) and _file_hash(image) == _file_hash(path):
+        os.unlink(path)
+        sys.stdout.write(f'Installed image for {kernel_ver} is up to '
+                         f'date.\n')
+        return
+
+    try:
+        os.replace(path, image)
+        _fsync_dir(BOOT_DIR)
+    except OSError as exc:
+        if os.path.lexists(path):
+            os.unlink(path)
+        raise BuildError(13, f'Error: Installing image failed: {exc}\n')
+
+
+def _kernel_config(kernel_ver, root='/'):
+    """
+    Return dictionary with the kernel config options for provided kernel
+    version or None, if kernel config cannot be found.
+    """
+    paths = [_host_path(root, p) for p in
+             (os.path.join('/lib/modules', kernel_ver, 'build/.config'),
+              f'/boot/config-{kernel_ver}')]
+    if _default_kernel(root) == kernel_ver:
+        paths.insert(0, _host_path(root, '/usr/src/linux/.config'))
+    if root == '/' and os.uname().release == kernel_ver:
+        paths.append('/proc/config.gz')
+
+    for path in paths:
+        opener = gzip.open if path.endswith('.gz') else open
+        try:
+            with opener(path, 'rt') as fobj:
+                return dict(line.strip().split('=', 1) for line in fobj
+                            if line.startswith('CONFIG_') and '=' in line)
+        except OSError:
+            continue
+    return None
+
+
+class Timings:
+    """
+    Collect wall and CPU time along with I/O counters for the build phases.
+    """
+    fields = ('wall', 'cpu', 'files', 'bytes', 'subprocesses')
+
+    def __init__(self):
+        self.phases = []
+        self._start = time.perf_counter()
+        # phases might run concurrently, each one in its own thread
+        self._local = threading.local()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        stats = {'phase': name, 'start': 0.0, 'wall': 0.0, 'cpu': 0.0,
+                 'files': 0, 'bytes': 0, 'subprocesses': 0,
+                 'critical': False}
+        self._local.current = stats
+        start = time.perf_counter()
+        stats['start'] = start - self._start
+        times = os.times()
+        try:
+            yield stats
+        finally:
+            end = os.times()
+            stats['wall'] = time.perf_counter() - start
+            stats['cpu'] = sum(end[i] - times[i] for i in range(4))
+            self.phases.append(stats)
+            self._local.current = None
+
+    def count(self, files=0, size=0, subprocesses=0):
+        current = getattr(self._local, 'current', None)
+        if current:
+            current['files'] += files
+            current['bytes'] += size
+            current['subprocesses'] += subprocesses
+
+
+def _report_timings(results, json_path=None):
+    """
+    Print the summary of collected timings for every built image, and
+    optionally write them down as JSON.
+    """
+    for name, phases in results.items():
+        total = {'phase': 'total'}
+        for field in Timings.fields:
+            total[field] = sum(p[field] for p in phases)
+        if phases:
+            # phases might overlap, so wall time is taken from the first
+            # start to the last end
+            total['wall'] = (max(p['start'] + p['wall'] for p in phases) -
+                             min(p['start'] for p in phases))
+        sys.stdout.write(f'{name}:\n{"phase":<20} {"wall [s]":>9} '
+                         f'{"cpu [s]":>9} {"files":>7} {"bytes":>12} '
+                         f'{"subproc":>7}\n')
+        for stats in phases + [total]:
+            sys.stdout.write(f'{stats["phase"]:<20} {stats["wall"]:>9.3f} '
+                             f'{stats["cpu"]:>9.3f} {stats["files"]:>7} '
+                             f'{stats["bytes"]:>12} '
+                             f'{stats["subprocesses"]:>7}\n')
+        critical = [p for p in phases if p['critical']]
+        if critical:
+            sys.stdout.write(f'critical path: '
+                             f'{" > ".join(p["phase"] for p in critical)} '
+                             f'({sum(p["wall"] for p in critical):.3f} s)\n')
+
+    if json_path:
+        with open(json_path, 'w') as fobj:
+            json.dump({'time': time.time(), 'images': results}, fobj,
+                      indent=2)
+
+
+def _read_boot_timings(path):
+    """
+    Return list of (stage, duration) tuples out of the init trace log. First
+    stage is the time spent by kernel, before init was started.
+    """
+    with open(path) as fobj:
+        marks = [line.split(None, 1) for line in fobj if line.strip()]
+    stages = [('kernel', float(marks[0][0]))] if marks else []
+    for (start, stage), (end, _) in zip(marks, marks[1:]):
+        stages.append((stage.strip(), float(end) - float(start)))
+    return stages
+
+
+def _report_boot_timings(paths):
+    """
+    Print the mean and maximal duration of every boot stage out of the init
+    trace logs, followed by the total boot times, the slowest first.
+    """
+    stages = {}
+    totals = []
+    for path in paths:
+        try:
+            timings = _read_boot_timings(path)
+        except (OSError, ValueError) as exc:
+            sys.stderr.write(f'Cannot read {path}: {exc}\n')
+            continue
+        for stage, duration in timings:
+            stages.setdefault(stage, []).append(duration)
+        totals.append((sum(d for _, d in timings), path))
+
+    sys.stdout.write(f'{"stage":<20} {"boots":>7} {"mean [s]":>9} '
+                     f'{"max [s]":>9}\n')
+    for stage, durations in stages.items():
+        sys.stdout.write(f'{stage:<20} {len(durations):>7} '
+                         f'{sum(durations) / len(durations):>9.3f} '
+                         f'{max(durations):>9.3f}\n')
+    sys.stdout.write('\ntotal [s] log\n')
+    for total, path in sorted(totals, reverse=True):
+        sys.stdout.write(f'{total:>9.3f} {path}\n')
+
+
+def _inspect(path):
+    """
+    List entries of the existing image along with the sha256 of the regular
+    files contents.
+    """
+    count = size = 0
+    with open(path, 'rb') as fobj:
+        reader = CpioReader(fobj)
+        for entry in reader:
+            name = entry['name']
+            if 'target' in entry:
+                name += ' -> ' + entry['target']
+            sys.stdout.write(f'{stat.filemode(entry["mode"])} '
+                             f'{entry["uid"]}/{entry["gid"]} '
+                             f'{entry["size"]:>10} '
+                             f'{entry.get("sha256", "-")[:16]:<16} {name}\n')
+            count += 1
+            size += entry['size']
+    sys.stdout.write(f'{count} entries, {size} bytes, compression: '
+                     f'{", ".join(reader.segments)}\n')
+
+
 class Config:
-    defaults = {'copy_modules': False,
+    defaults = {'cache': False,
+                'compression': 'gzip',
+                'compression_level': None,
+                'compression_threads': None,
+                'copy_modules': False,
+                'copy_threads': None,
                 'disk_label': None,
                 'dropbear': False,
                 'install': False,
+                'kernels': None,
                 'key_path': None,
+                'layered': False,
                 'lvm': False,
+                'manifest': False,
+                'minimal': False,
+                'modules': None,
                 'no_key': False,
+                'race': False,
+                'rescue_commands': None,
+                'root': '/',
                 'sdcard': None,
+                'strip': False,
+                'timings': False,
+                'timings_json': None,
+                'trace': False,
                 'yubikey': False}
 
-    def __init__(self, args, toml_conf):
-        self.drive = args.get('drive')
+    # options which affects the common part of the image, shared between
+    # the drives
+    base_options = ('copy_modules', 'dropbear', 'kernels', 'lvm', 'manifest',
+                    'minimal', 'modules', 'rescue_commands', 'root', 'strip',
+                    'yubikey')
+
+    def __init__(self, args, toml_conf, drive):
+        self.drive = drive
         toml_ = toml_conf[self.drive]
 
         for k, v in self.defaults.items():
             setattr(self, k, toml_.get(k, v))
-            if getattr(self, k) is not args.get(k) and args.get(k) is not None:
+            # flags which are not set on commandline should not override
+            # those from config file
+            if args.get(k) is not None and args.get(k) is not False:
                 setattr(self, k, args[k])
 
+        if self.modules:
+            self.modules = tuple(self.modules)
+        if self.kernels:
+            self.kernels = tuple(self.kernels)
+        if self.rescue_commands:
+            self.rescue_commands = tuple(self.rescue_commands)
+        self.root = os.path.abspath(self.root)
+
+        if self.cache and self.manifest:
+            sys.stderr.write('Options cache and manifest cannot be used '
+                             'together.\n')
+            sys.exit(12)
+
         key = None
         if not self.key_path and toml_.get('key'):
             key = toml_.get('key')
@@ -354,80 +1904,597 @@ class Config:
             sys.exit(7)
         self.authorized_keys = toml_.get('authorized_keys', ROOT_AK)
 
+    def base_key(self):
+        return tuple(getattr(self, k) for k in self.base_options)
+
 
 class Initramfs:
-    def __init__(self, conf):
+    def __init__(self, conf, output='initramfs.cpio', kernel_ver=None):
         self.conf = conf
+        self.output = output
+        # installation of the image is left to the caller, which installs
+        # images for several kernels at once
+        self.defer_install = False
         self.key = None
         self.dirname = None
-        self.kernel_ver = os.readlink('/usr/src/linux').replace('linux-', '')
-        self._make_tmp()
+        self.manifest = None
+        self.base = None
+        self.libs = LibIndex(root=conf.root)
+        self.timings = Timings()
+        # stage run by the current thread, along with its pending copies
+        self._local = threading.local()
+        self.kernel_ver = kernel_ver or _kernel_versions(conf)[0]
+        self.name = conf.drive
+        if conf.kernels:
+            self.name = f'{conf.drive}-{self.kernel_ver}'
+
+    def _make_tmp(self, name=None):
+        self._touched = set()
+        self._records = {}
+        self._pending = {}
+        self._strip_dir = None
+        self._overlay = set()
+        if self.conf.manifest:
+            # nothing is written to the disk, files are archived straight
+            # from their locations
+            self.manifest = {}
+            return
+        self._pool = concurrent.futures.ThreadPoolExecutor(
+            self.conf.copy_threads or min(32, (os.cpu_count() or 1) * 4))
+        if not self.conf.cache:
+            self.dirname = tempfile.mkdtemp(prefix='init_')
+            return
 
-    def _make_tmp(self):
-        self.dirname = tempfile.mkdtemp(prefix='init_')
-        self.curdir = os.path.abspath(os.curdir)
+        # staging directory is kept between the builds, and only changed
+        # files are copied over
+        self.dirname = os.path.join(CACHE_PATH, 'staging',
+                                    name or self.name)
+        os.makedirs(self.dirname, exist_ok=True)
+        os.chmod(self.dirname, 0b111000000)
+        try:
+            with open(self.dirname + '.json') as fobj:
+                self._records = json.load(fobj)
+        except (OSError, ValueError):
+            pass
+
+    def _path(self, dest):
+        return os.path.join(self.dirname, dest)
+
+    def _host(self, path):
+        return _host_path(self.conf.root, path)
+
+    def _in_overlay(self):
+        stage = getattr(self._local, 'stage', None)
+        return stage is not None and stage.part == 'drive'
+
+    def _touch(self, dest):
+        # everything put by drive specific stages lands in the overlay of
+        # layered image
+        if self._in_overlay():
+            self._overlay.add(dest)
+        while dest and dest not in self._touched:
+            self._touched.add(dest)
+            dest = os.path.dirname(dest)
+
+    def _add_entry(self, dest, entry):
+        if self._in_overlay():
+            self._overlay.add(dest)
+        parent = os.path.dirname(dest)
+        if parent and parent not in self.manifest:
+            self._add_entry(parent, ('dir', None, 0b111101101))
+        self.manifest[dest] = entry
+
+    def _mkdir(self, dest):
+        if self.manifest is not None:
+            if dest not in self.manifest:
+                self._add_entry(dest, ('dir', None, 0b111101101))
+            return
+        os.makedirs(self._path(dest), exist_ok=True)
+        self._touch(dest)
+
+    def _symlink(self, target, dest):
+        if self.manifest is not None:
+            self._add_entry(dest, ('symlink', target, 0b111111111))
+            return
+        path = self._path(dest)
+        self._touch(dest)
+        self._settle(dest)
+        if os.path.islink(path):
+            if os.readlink(path) == target:
+                return
+            os.unlink(path)
+        elif os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.unlink(path)
+        os.symlink(target, path)
+
+    def _write(self, dest, data, mode=0b110100100):
+        if isinstance(data, str):
+            data = data.encode()
+        self.timings.count(files=1, size=len(data))
+        if self.manifest is not None:
+            self._add_entry(dest, ('data', data, mode))
+            return
+
+        path = self._path(dest)
+        self._touch(dest)
+        self._settle(dest)
+        self._records.pop(dest, None)
+        if os.path.lexists(path):
+            os.unlink(path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as fobj:
+            fobj.write(data)
+        os.chmod(path, mode)
+
+    def _is_cached(self, src, dest):
+        record = self._records.get(dest)
+        path = self._path(dest)
+        if not record or os.path.islink(path) or not os.path.isfile(path):
+            return False
+        # file have to be copied again, if it was stripped and stripping is
+        # disabled now, and vice versa
+        if (len(record) > 4) != self.conf.strip:
+            return False
+
+        st = os.stat(src)
+        if record[:3] == [src, st.st_size, st.st_mtime_ns]:
+            return True
+        # source have been touched or moved, but the contents might be still
+        # the same
+        if record[1] == st.st_size and record[3] == _file_hash(src):
+            self._records[dest] = [src, st.st_size, st.st_mtime_ns,
+                                   record[3]]
+            return True
+        return False
+
+    def _copy(self, src, dest, follow_symlinks=True):
+        dest = os.path.join(dest, os.path.basename(src))
+        if not follow_symlinks and os.path.islink(src):
+            self._symlink(os.readlink(src), dest)
+            return dest
+        # contents are taken from the file the link points to in the root
+        src = _host_realpath(self.conf.root, src)
+
+        if self.manifest is not None:
+            self.timings.count(files=1)
+            self._add_entry(dest, ('file', src, None))
+            return dest
+
+        self._touch(dest)
+        self._settle(dest)
+        if self._is_cached(src, dest):
+            return dest
+
+        path = self._path(dest)
+        if os.path.islink(path) or os.path.isfile(path):
+            os.unlink(path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.timings.count(files=1, size=os.stat(src).st_size)
+        future = self._pool.submit(self._copy_file, src, dest)
+        self._pending[dest] = future
+        if not hasattr(self._local, 'copies'):
+            self._local.copies = []
+        self._local.copies.append((dest, future))
+        return dest
+
+    def _copy_file(self, src, dest):
+        _copy_file(src, self._path(dest))
+        if self.conf.cache:
+            st = os.stat(src)
+            self._records[dest] = [src, st.st_size, st.st_mtime_ns,
+                                   _file_hash(src)]
+
+    def _settle(self, dest):
+        """
+        Wait for pending copy to the dest, if any
+        """
+        future = self._pending.pop(dest, None)
+        if future:
+            future.result()
+
+    def _wait_copies(self):
+        """
+        Wait for the copies started by the current thread.
+        """
+        copies = getattr(self._local, 'copies', [])
+        self._local.copies = []
+        for dest, future in copies:
+            future.result()
+            if self._pending.get(dest) is future:
+                self._pending.pop(dest, None)
+
+    def _run(self, cmd, **kwargs):
+        self.timings.count(subprocesses=1)
+        return subprocess.run(cmd, **kwargs)
+
+    def _copytree(self, src, dest):
+        for root, dirs, files in os.walk(src):
+            rel = os.path.normpath(os.path.join(dest,
+                                                os.path.relpath(root, src)))
+            self._mkdir(rel)
+            for name in dirs + files:
+                path = os.path.join(root, name)
+                if os.path.islink(path):
+                    self._symlink(os.readlink(path), os.path.join(rel, name))
+                elif name in files:
+                    self._copy(path, rel)
+
+    def _prune(self):
+        """
+        Remove everything from the cached staging directory, which was not
+        a part of the current build
+        """
+        for root, dirs, files in os.walk(self.dirname, topdown=False):
+            for name in dirs + files:
+                path = os.path.join(root, name)
+                dest = os.path.relpath(path, self.dirname)
+                if dest in self._touched:
+                    continue
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path)
+                else:
+                    os.unlink(path)
+                self._records.pop(dest, None)
 
     def _make_dirs(self):
-        os.chdir(self.dirname)
         for dir_ in ('bin', 'dev', 'etc', 'keys', 'lib64', 'proc', 'root',
                      'run/cryptsetup', 'run/lock', 'sys', 'tmp'):
-            os.makedirs(os.path.join(self.dirname, dir_))
+            self._mkdir(dir_)
 
         for link, target in (('lib', 'lib64'), ('sbin', 'bin'),
                              ('linuxrc', 'bin/busybox')):
-            os.symlink(target, link)
-        os.chdir(self.curdir)
+            self._symlink(target, link)
+
+    def _get_deps(self):
+        deps = list(DEPS)
+        if self.conf.minimal:
+            # busybox is always needed, binaries for explicitly enabled
+            # features are kept even if not called by the scripts
+            commands = self._commands()
+            deps = [path for path in deps if path == '/bin/busybox' or
+                    os.path.basename(path) in commands]
+        if self.conf.lvm:
+            deps.extend(LVM_DEPS)
+        if self.conf.yubikey:
+            deps.extend(YUBIKEY_DEPS)
+        if self.conf.dropbear:
+            deps.extend(DROPBEAR_DEPS)
+        return deps
+
+    def _resolve_deps(self):
+        deps = []
+        for path in self._get_deps():
+            if os.path.exists(_host_realpath(self.conf.root,
+                                             self._host(path))):
+                deps.append(self._host(path))
+            else:
+                sys.stderr.write(f'Warning: {path} not found.\n')
+        elf = ElfDeps(self.conf.root)
+        libs = elf.resolve(deps)
+        for name, path in elf.missing.items():
+            sys.stderr.write(f'Warning: library {name} needed by {path} not '
+                             f'found.\n')
+        return deps, libs
+
+    def _inputs(self):
+        """
+        Return paths of the files on the host which the image is made of.
+        """
+        deps, libs = self._resolve_deps()
+        paths = set(deps + libs)
+        paths.update([os.path.realpath(_host_realpath(self.conf.root, path))
+                      for path in paths])
+        paths.update([os.path.realpath(__file__),
+                      self._host(LD_SO_CACHE),
+                      self._host('/usr/src/linux')])
+        if self.conf.copy_modules:
+            paths.add(self._host(os.path.join('/lib/modules',
+                                              self.kernel_ver,
+                                              'modules.dep')))
+        if not self.conf.no_key:
+            paths.add(os.path.abspath(self.conf.key_path))
+        if self.conf.yubikey:
+            paths.add(os.path.abspath(self.conf.key_path + '.yk'))
+        if self.conf.dropbear:
+            paths.update([self.conf.authorized_keys,
+                          self._host('/etc/localtime'),
+                          self._host('/etc/ssh/ssh_host_ecdsa_key')])
+            paths.update(ASKPASS_SOURCES)
+        return sorted(paths)
+
+    def _fingerprint(self, inputs):
+        """
+        Return hash of the configuration and the state of the input files,
+        which tells whether prebuilt image is still valid.
+        """
+        options = {k: v for k, v in vars(self.conf).items()
+                   if k not in WATCH_IGNORED}
+        state = [repr(sorted(options.items())), self.kernel_ver]
+        for path in inputs:
+            try:
+                st = os.stat(path)
+            except OSError:
+                state.append(f'{path} -')
+                continue
+            state.append(f'{path} {st.st_size} {st.st_mtime_ns}')
+        return hashlib.sha256('\n'.join(state).encode()).hexdigest()
+
+    def _prebuilt(self):
+        """
+        Put the image prebuilt in watch mode on /boot, if it was made out of
+        the same inputs. Returns True on success.
+        """
+        path = os.path.join(CACHE_PATH, 'prebuilt',
+                            f'{self.conf.drive}-{self.kernel_ver}')
+        try:
+            with open(path + '.json') as fobj:
+                if json.load(fobj) != self._fingerprint(self._inputs()):
+                    return False
+            src = open(path, 'rb')
+        except (OSError, ValueError):
+            return False
+
+        _fd, self.cpio_arch = tempfile.mkstemp(prefix='.initramfs-',
+                                               suffix='.tmp', dir=BOOT_DIR)
+        try:
+            with src, open(_fd, 'wb') as fobj:
+                shutil.copyfileobj(src, fobj, CPIO_BUFSIZE)
+                os.fchmod(fobj.fileno(), 0b110100100)
+                os.fsync(fobj.fileno())
+        except BaseException:
+            os.unlink(self.cpio_arch)
+            raise
+        if not self.defer_install:
+            _make_boot_links(self.cpio_arch, self.kernel_ver)
+        return True
+
+    def list_deps(self):
+        deps, libs = self._resolve_deps()
+        for path in deps:
+            sys.stdout.write(f'{path} => bin/{os.path.basename(path)}\n')
+        for path in libs:
+            sys.stdout.write(f'{path} => lib64/{os.path.basename(path)}\n')
+
+    def plan(self, top=10):
+        """
+        Resolve everything which would be put into the image without copying
+        it, and print the sizes of every part of the image, the size of the
+        image compressed with every available method and the largest files.
+        Configuration have to be in manifest mode.
+        """
+        self._make_tmp()
+        try:
+            self._run_stages(('base', 'kernel', 'drive'))
+        except BaseException:
+            self._cleanup()
+            raise
+
+        categories = {}
+        files = []
+        for name, (kind, value, _) in self.manifest.items():
+            if kind == 'dir':
+                continue
+            if kind == 'file':
+                size = os.stat(value).st_size
+            else:
+                size = 0 if kind == 'hardlink' else len(value)
+            if kind in ('symlink', 'hardlink'):
+                category = 'links'
+            elif name.startswith('lib64/modules/'):
+                category = 'modules'
+            elif name.startswith('keys/'):
+                category = 'keys'
+            elif kind == 'data':
+                category = 'generated'
+            elif name.startswith('lib64/'):
+                category = 'libraries'
+            else:
+                category = 'binaries'
+            count, total = categories.get(category, (0, 0))
+            categories[category] = (count + 1, total + size)
+            files.append((size, name))
+
+        compressed = {}
+        with tempfile.TemporaryFile() as raw:
+            writer = CpioWriter(raw)
+            writer.add_manifest(self.manifest)
+            writer.close()
+            compressed['none'] = writer.offset
+            for method in sorted(COMPRESSION):
+                compressor = Compressor(None, method,
+                                        self.conf.compression_level,
+                                        self.conf.compression_threads)
+                if method not in ('gzip', 'xz') and not compressor.command():
+                    continue
+                with tempfile.TemporaryFile() as fobj:
+                    compressor.fobj = fobj
+                    with compressor as stream:
+                        raw.seek(0)
+                        shutil.copyfileobj(raw, stream, CPIO_BUFSIZE)
+                    compressed[method] = os.fstat(fobj.fileno()).st_size
+        self._cleanup()
+
+        sys.stdout.write(f'{self.conf.drive}:\n{"category":<20} {"files":>7} '
+                         f'{"bytes":>12}\n')
+        for category, (count, size) in sorted(categories.items()):
+            sys.stdout.write(f'{category:<20} {count:>7} {size:>12}\n')
+        sys.stdout.write(f'{"total":<20} {len(files):>7} '
+                         f'{sum(s for s, _ in files):>12}\n\n')
+        sys.stdout.write(f'{"compression":<20} {"bytes":>12}\n')
+        for method, size in compressed.items():
+            mark = ' *' if method == self.conf.compression else ''
+            sys.stdout.write(f'{method:<20} {size:>12}{mark}\n')
+        sys.stdout.write(f'\n{"bytes":>12} largest files\n')
+        for size, name in sorted(files, reverse=True)[:top]:
+            sys.stdout.write(f'{size:>12} {name}\n')
+
+    def diff(self, image):
+        """
+        Compare the existing image with the one which would be built, and
+        print entries which are only in the image (-), only in the new build
+        (+) or differ (M). Configuration have to be in manifest mode. Returns
+        True, if there are any differences.
+        """
+        self._make_tmp()
+        try:
+            self._run_stages(('base', 'kernel', 'drive'))
+        except BaseException:
+            self._cleanup()
+            raise
+        planned = {}
+        for name, (kind, value, mode) in self.manifest.items():
+            if kind == 'dir':
+                planned[name] = (stat.S_IFDIR | mode, 0, None)
+            elif kind == 'file':
+                st = os.stat(value)
+                planned[name] = (st.st_mode, st.st_size, _file_hash(value))
+            elif kind == 'data':
+                planned[name] = (stat.S_IFREG | mode, len(value),
+                                 hashlib.sha256(value).hexdigest())
+            elif kind == 'symlink':
+                planned[name] = (stat.S_IFLNK | mode, len(value.encode()),
+                                 value)
+        for name, (kind, value, _) in self.manifest.items():
+            if kind == 'hardlink':
+                planned[name] = planned[value]
+        self._cleanup()
+
+        current = {}
+        with open(image, 'rb') as fobj:
+            for entry in CpioReader(fobj):
+                current[entry['name']] = (entry['mode'], entry['size'],
+                                          entry.get('sha256',
+                                                    entry.get('target')))
+        changes = [('-', name) for name in current if name not in planned]
+        for name, entry in planned.items():
+            if name not in current:
+                changes.append(('+', name))
+            elif current[name] != entry:
+                changes.append(('M', name))
+
+        for change, name in sorted(changes, key=lambda x: x[1]):
+            sys.stdout.write(f'{change} {name}\n')
+        return bool(changes)
 
     def _copy_deps(self):
-        additional_libs = ['libgcc_s']
-        os.chdir(self.dirname)
-        _fd, fname = tempfile.mkstemp(dir=self.dirname, suffix='.sh')
-        os.close(_fd)
-        with open(fname, 'w') as fobj:
-            lvm = '/sbin/lvscan\n/sbin/vgchange' if self.conf.lvm else ''
-            yubikey = '/usr/bin/ykchalresp' if self.conf.yubikey else ''
-            dropbear = '/usr/sbin/dropbear' if self.conf.dropbear else ''
-            fobj.write(SHEBANG)
-            fobj.write(DEPS % {'lvm': lvm, 'yubikey': yubikey,
-                               'dropbear': dropbear})
-            fobj.write(COPY_DEPS % ('true' if self.conf.dropbear else 'false'))
+        deps, libs = self._resolve_deps()
+        for path in deps:
+            self._copy(path, 'bin')
+        for path in libs:
+            self._copy(path, 'lib64')
 
         # extra crap, which seems to be needed, but is not direct dependency
-        for root, _, fnames in os.walk('/usr/lib'):
-            if '32' in root:
+        for path in self.libs.find('libgcc_s', '/usr/lib'):
+            if '32' in os.path.dirname(path):
+                continue
+            self._copy(path, 'lib64', follow_symlinks=False)
+
+        # extra lib for new version of cryptsetup, which need to do locks
+        for path in self.libs.find('libgcc_s', '/usr/lib/gcc'):
+            if (os.path.basename(path) != 'libgcc_s.so.1' or
+                    os.path.basename(os.path.dirname(path)) == '32'):
                 continue
+            self._copy(path, 'lib64')
 
-            for f in fnames:
-                if f.split('.')[0] in additional_libs:
-                    shutil.copy(os.path.join(root, f), 'lib64',
-                                follow_symlinks=False)
         self._copy_dropbear_deps()
+        self._copy_askpass()
+
+    def _copy_askpass(self):
+        if not self.conf.dropbear:
+            return
 
-        os.chmod(fname, 0b111101101)
-        subprocess.call([fname])
-        os.unlink(fname)
-        os.chdir(self.curdir)
+        self._copy(self._build_askpass(), 'bin')
+
+    def _build_askpass(self):
+        """
+        Return path to the static askpass binary built out of askpass.c. It
+        is kept in cache, as long as the source, compiler and flags are the
+        same.
+        """
+        for source in ASKPASS_SOURCES:
+            if os.path.exists(source):
+                break
+        else:
+            raise BuildError(8, f"Error: Unable to find the 'askpass.c' in "
+                             f"{' nor '.join(ASKPASS_SOURCES)}. Aborting\n")
+
+        # CC might come with arguments, like "ccache gcc" or "gcc -m64"
+        compiler = shlex.split(os.getenv('CC') or 'gcc')
+        try:
+            version = self._run([*compiler, '--version'],
+                                capture_output=True).stdout
+        except OSError:
+            version = None
+        if not version:
+            raise BuildError(8, f'Error: Compiler {shlex.join(compiler)} '
+                             f'not found. Aborting\n')
+
+        digest = hashlib.sha256(version)
+        digest.update(' '.join([*compiler[1:], *ASKPASS_CFLAGS]).encode())
+        with open(source, 'rb') as fobj:
+            digest.update(fobj.read())
+        cache = os.path.join(CACHE_PATH, 'askpass')
+        key = digest.hexdigest()[:16]
+        askpass = os.path.join(cache, key, 'askpass')
+
+        # used binary is touched, so that it isn't removed as the stale one
+        # by concurrent builds
+        try:
+            os.utime(os.path.dirname(askpass))
+        except FileNotFoundError:
+            pass
+        if not os.path.exists(askpass):
+            start = time.time()
+            os.makedirs(os.path.dirname(askpass), exist_ok=True)
+            _fd, tmp = tempfile.mkstemp(prefix='.askpass-',
+                                        dir=os.path.dirname(askpass))
+            os.close(_fd)
+            if self._run([*compiler, *ASKPASS_CFLAGS, source, '-o',
+                          tmp]).returncode:
+                os.unlink(tmp)
+                raise BuildError(15, "Error: Unable to compile "
+                                 "'askpass.c'. Aborting\n")
+            os.chmod(tmp, 0b111101101)
+            os.replace(tmp, askpass)
+            # binaries built with other compiler or from the older source,
+            # which weren't used since this build started
+            for name in os.listdir(cache):
+                path = os.path.join(cache, name)
+                try:
+                    if name != key and os.path.getmtime(path) < start:
+                        shutil.rmtree(path)
+                except FileNotFoundError:
+                    pass
+
+        info = _read_elf(askpass)
+        if not info or info['interp'] or info['needed']:
+            raise BuildError(16, f'Error: {askpass} is not statically '
+                             f'linked. Aborting\n')
+        return askpass
 
     def _copy_dropbear_deps(self):
         if not self.conf.dropbear:
             return
 
-        for dir_ in ('root/.ssh', 'etc/dropbear'):
-            os.makedirs(os.path.join(self.dirname, dir_))
+        for name in ('libnss_compat', 'libnss_files'):
+            for path in self.libs.find(name, '/lib64'):
+                self._copy(path, 'lib64', follow_symlinks=False)
 
-        additional_libs = ['libnss_compat', 'libnss_files']
-        for root, _, fnames in os.walk('/lib64'):
-            for f in fnames:
-                if f.split('.')[0] in additional_libs:
-                    shutil.copy(os.path.join(root, f), 'lib64',
-                                follow_symlinks=False)
+        self._copy(self._host('/etc/localtime'), 'etc')
 
-        shutil.copy('/etc/localtime', 'etc')
+    def _copy_dropbear_conf(self):
+        if not self.conf.dropbear:
+            return
+
+        for dir_ in ('root/.ssh', 'etc/dropbear'):
+            self._mkdir(dir_)
 
         # Copy the authorized keys for your regular user you administrate with
         if (self.conf.authorized_keys and
             os.path.exists(self.conf.authorized_keys)):
-            shutil.copy(self.conf.authorized_keys, 'root/.ssh')
+            self._copy(self.conf.authorized_keys, 'root/.ssh')
         else:
             sys.stderr.write(f'Warning {self.conf.authorized_keys} not found!')
 
@@ -436,69 +2503,196 @@ class Initramfs:
         # keys and chicken out. Here we only copy the ecdsa host key, because
         # ecdsa is default with OpenSSH. For RSA and others, copy adequate
         # keyfile.
-        subprocess.run(['dropbearconvert', 'openssh', 'dropbear',
-                        '/etc/ssh/ssh_host_ecdsa_key',
-                        'etc/dropbear/dropbear_ecdsa_host_key'])
+        tmpdir = tempfile.mkdtemp(prefix='dropbear_')
+        host_key = os.path.join(tmpdir, 'dropbear_ecdsa_host_key')
+        self._run(['dropbearconvert', 'openssh', 'dropbear',
+                   self._host('/etc/ssh/ssh_host_ecdsa_key'), host_key])
+        if os.path.exists(host_key):
+            with open(host_key, 'rb') as fobj:
+                self._write('etc/dropbear/dropbear_ecdsa_host_key',
+                            fobj.read(), 0b110000000)
+        shutil.rmtree(tmpdir)
 
         # Basic system defaults
-        with open('etc/passwd', 'w') as fobj:
-            fobj.write(f"{self.conf.user}:x:0:0:root:/root:/bin/sh\n")
-        with open('etc/shadow', 'w') as fobj:
-            fobj.write(f"{self.conf.user}:*:::::::\n")
-        with open('etc/group', 'w') as fobj:
-            fobj.write(f"{self.conf.user}:x:0:{self.conf.user}\n")
-        with open('etc/shells', 'w') as fobj:
-            fobj.write("/bin/sh\n")
-        os.chmod('etc/shadow', 0b110100000)
-        with open('etc/nsswitch.conf', 'w') as fobj:
-            fobj.write("passwd:  files\n"
-                       "shadow:  files\n"
-                       "group:   files\n")
+        self._write('etc/passwd',
+                    f"{self.conf.user}:x:0:0:root:/root:/bin/sh\n")
+        self._write('etc/shadow', f"{self.conf.user}:*:::::::\n",
+                    0b110100000)
+        self._write('etc/group', f"{self.conf.user}:x:0:{self.conf.user}\n")
+        self._write('etc/shells', "/bin/sh\n")
+        self._write('etc/nsswitch.conf', "passwd:  files\n"
+                    "shadow:  files\n"
+                    "group:   files\n")
 
     def _copy_modules(self):
         if not self.conf.copy_modules:
             return
-        os.chdir(self.dirname)
-        os.mkdir(os.path.join('lib', 'modules'))
-        os.chdir('lib/modules')
-        shutil.copytree(os.path.join('/lib/modules/', self.kernel_ver),
-                        self.kernel_ver, symlinks=True)
-        os.chdir(self.curdir)
+        src = self._host(os.path.join('/lib/modules/', self.kernel_ver))
+        dest = os.path.join('lib64', 'modules', self.kernel_ver)
+        if not self.conf.modules:
+            self._copytree(src, dest)
+            return
+
+        modules = KernelModules(src)
+        selected = modules.resolve(self.conf.modules)
+        for item in modules.missing:
+            sys.stderr.write(f'Warning: kernel module {item} not found.\n')
+
+        self._mkdir(dest)
+        for name in sorted(selected):
+            path = modules.deps[name][0]
+            self._copy(os.path.join(src, path),
+                       os.path.join(dest, os.path.dirname(path)))
+        for fname in ('modules.dep', 'modules.alias', 'modules.softdep',
+                      'modules.symbols', 'modules.order'):
+            self._write(os.path.join(dest, fname),
+                        modules.trimmed(fname, selected))
+        for fname in ('modules.builtin', 'modules.builtin.modinfo'):
+            if os.path.exists(os.path.join(src, fname)):
+                self._copy(os.path.join(src, fname), dest)
 
     def _copy_wlan_modules(self):
-        path = ('lib/modules/' + self.kernel_ver +
-                '/kernel/drivers/net/wireless/intel/iwlwifi')
-        os.chdir(self.dirname)
-        os.makedirs(os.path.join(path, 'dvm'))
-        os.makedirs(os.path.join(path, 'mvm'), exist_ok=True)
-        shutil.copy2(os.path.join('/', path, 'dvm', 'iwldvm.ko'),
-                     os.path.join(path, 'dvm'))
-        shutil.copy2(os.path.join('/', path, 'mvm', 'iwlmvm.ko'),
-                     os.path.join(path, 'mvm'))
-        shutil.copy2(os.path.join('/', path, 'iwlwifi.ko'), path)
-        os.chdir(self.curdir)
+        path = 'kernel/drivers/net/wireless/intel/iwlwifi'
+        src = self._host(os.path.join('/lib/modules', self.kernel_ver, path))
+        dest = os.path.join('lib64/modules', self.kernel_ver, path)
+        self._mkdir(os.path.join(dest, 'dvm'))
+        self._mkdir(os.path.join(dest, 'mvm'))
+        self._copy(os.path.join(src, 'dvm', 'iwldvm.ko'),
+                   os.path.join(dest, 'dvm'))
+        self._copy(os.path.join(src, 'mvm', 'iwlmvm.ko'),
+                   os.path.join(dest, 'mvm'))
+        self._copy(os.path.join(src, 'iwlwifi.ko'), dest)
 
     def _populate_busybox(self):
-        os.chdir(os.path.join(self.dirname, 'bin'))
-        output = subprocess.check_output(['busybox', '--list']).decode('utf-8')
+        busybox = _host_realpath(self.conf.root, self._host('/bin/busybox'))
+        output = self._run([busybox, '--list'],
+                           check=True, stdout=subprocess.PIPE)
+        output = output.stdout.decode('utf-8')
+        commands = self._commands() if self.conf.minimal else None
         for command in output.split('\n'):
             if not command or command == 'busybox':
                 continue
-            os.symlink('busybox', command)
+            if commands is not None and command not in commands:
+                continue
+            self._symlink('busybox', os.path.join('bin', command))
+
+    def _strip(self):
+        """
+        Strip ELF binaries and libraries (kernel modules are left intact, as
+        they might be signed), and replace identical files with links to the
+        single copy.
+        """
+        # drive specific files, which might be put concurrently, are left
+        # out
+        if self.manifest is not None:
+            files = {dest: value for dest, (kind, value, _) in
+                     list(self.manifest.items())
+                     if kind == 'file' and dest not in self._overlay}
+        else:
+            files = {}
+            for root, _, fnames in os.walk(self.dirname):
+                for fname in fnames:
+                    path = os.path.join(root, fname)
+                    dest = os.path.relpath(path, self.dirname)
+                    if (dest in self._touched and dest not in self._overlay
+                            and os.path.isfile(path)
+                            and not os.path.islink(path)):
+                        files[dest] = path
+
+        strip = shutil.which('strip')
+        if not strip:
+            sys.stderr.write('Warning: there is no strip command, binaries '
+                             'are left intact.\n')
+        stripped = saved = 0
+        for dest, path in sorted(files.items()):
+            # cache record gets number of bytes saved by stripping, once the
+            # file is stripped or it turns out there is nothing to strip
+            record = self._records.get(dest)
+            if record and len(record) > 4:
+                # already stripped in the previous build
+                stripped += record[4]
+                continue
+            if not strip:
+                continue
+            if dest.startswith('lib64/modules/'):
+                if record:
+                    self._records[dest] = record[:4] + [0]
+                continue
+            with open(path, 'rb') as fobj:
+                if fobj.read(4) != ELF_MAGIC:
+                    if record:
+                        self._records[dest] = record[:4] + [0]
+                    continue
+
+            if self.manifest is not None:
+                if not self._strip_dir:
+                    self._strip_dir = tempfile.mkdtemp(prefix='strip_')
+                out = os.path.join(self._strip_dir, dest)
+                os.makedirs(os.path.dirname(out), exist_ok=True)
+            else:
+                out = path + '.strip'
+            if self._run([strip, '--strip-unneeded', '-p', '-o', out, path],
+                         stderr=subprocess.DEVNULL).returncode:
+                if os.path.exists(out):
+                    os.unlink(out)
+                continue
+
+            size = os.stat(path).st_size - os.stat(out).st_size
+            stripped += size
+            if record:
+                self._records[dest] = record[:4] + [size]
+            if self.manifest is not None:
+                self.manifest[dest] = ('file', out, None)
+                files[dest] = out
+            else:
+                # never modify the file in place, it might be a hardlink to
+                # the source
+                os.replace(out, path)
+
+        sizes = {}
+        for dest, path in sorted(files.items()):
+            st = os.stat(path)
+            if st.st_size:
+                sizes.setdefault((st.st_size, st.st_mode), []).append(dest)
+        duplicates = {}
+        for (size, _), group in sizes.items():
+            if len(group) < 2:
+                continue
+            for dest in group:
+                key = (size, _file_hash(files[dest]))
+                duplicates.setdefault(key, []).append(dest)
+
+        for (size, _), group in duplicates.items():
+            first = group[0]
+            for dest in group[1:]:
+                if self.manifest is not None:
+                    self.manifest[dest] = ('hardlink', first, None)
+                elif os.path.samefile(files[first], files[dest]):
+                    # already linked in the previous build
+                    continue
+                else:
+                    os.link(files[first], files[dest] + '.link')
+                    os.replace(files[dest] + '.link', files[dest])
+                saved += size
+
+        sys.stdout.write(f'Stripping saved {stripped} bytes, replacing '
+                         f'duplicates with links saved {saved} bytes.\n')
+
+    def _copy_keys(self):
+        if not self.conf.no_key:
+            self._copy_key()
+        if self.conf.yubikey:
+            self._copy_key('.yk')
 
     def _copy_key(self, suffix=''):
         key_path = self.conf.key_path + suffix
 
         if not os.path.exists(key_path):
-            self._cleanup()
-            sys.stderr.write(f'Cannot find key(s) file for '
+            raise BuildError(2, f'Cannot find key(s) file for '
                              f'{self.conf.drive}.\n')
-            sys.exit(2)
 
         key_path = os.path.abspath(key_path)
-        os.chdir(self.dirname)
-        shutil.copy2(key_path, 'keys')
-        os.chdir(self.curdir)
+        self._copy(key_path, 'keys')
         if not (suffix or self.key):
             # set self.key only when:
             # - there is no key set to self
@@ -506,109 +2700,669 @@ class Initramfs:
             # so that we could get the key name calculated for the yk
             self.key = os.path.basename(key_path)
 
-    def _generate_init(self):
-        os.chdir(self.dirname)
-        with open('init', 'w') as fobj:
+    def _write_sequence(self, fobj, mark):
+        if self.conf.disk_label or self.conf.sdcard:
+            mark('keydev_unlock')
+            fobj.write(DECRYPT_KEYDEV)
+        if self.conf.yubikey:
+            mark('yubikey_unlock')
+            fobj.write(DECRYPT_YUBICP % {'disk': self.conf.drive})
+        if self.conf.dropbear:
+            mark('dropbear')
+            fobj.write(DROPBEAR % {'ip': self.conf.ip,
+                                   'gateway': self.conf.gateway,
+                                   'netmask': self.conf.netmask})
+        mark('password_unlock')
+        fobj.write(DECRYPT_PASSWORD)
+
+    def _write_race(self, fobj, mark):
+        fobj.write(RACE % {'disk': self.conf.drive})
+        if self.conf.dropbear:
+            mark('dropbear')
+            fobj.write(DROPBEAR % {'ip': self.conf.ip,
+                                   'gateway': self.conf.gateway,
+                                   'netmask': self.conf.netmask})
+        mark('unlock')
+        if self.conf.disk_label or self.conf.sdcard:
+            fobj.write('[ -n "${KEYDEV}" ] && race unlock_keydev\n')
+        if self.conf.yubikey:
+            fobj.write('race unlock_yubikey\n')
+        if self.conf.dropbear:
+            fobj.write('race unlock_remote\n')
+        if self.key:
+            fobj.write('race unlock_password\n')
+        fobj.write(RACE_WAIT)
+
+    def _scripts(self):
+        """
+        Return dictionary with the archive paths and contents of the
+        generated scripts.
+        """
+        scripts = {}
+        with io.StringIO() as fobj:
+            def mark(stage):
+                if self.conf.trace:
+                    fobj.write(f'\nmark {stage}\n')
+
             fobj.write(SHEBANG_ASH)
             fobj.write(f"UUID='{self.conf.uuid}'\n")
             if self.key:
                 fobj.write(f"KEY='/keys/{self.key}'\n")
             fobj.write(INIT)
+            if self.conf.trace:
+                fobj.write(TRACE % {'log': BOOT_TIMINGS})
+            mark('init')
+            fobj.write(WAIT_FOR)
             fobj.write(INIT_CMD)
+            if self.conf.disk_label or self.conf.sdcard:
+                mark('keydev_wait')
             if self.conf.disk_label:
                 fobj.write(INIT_LABELED % {'label': self.conf.disk_label})
             if self.conf.sdcard:
                 fobj.write(INIT_SD)
+            mark('root_wait')
             fobj.write(INIT_OPEN)
-            if self.conf.disk_label or self.conf.sdcard:
-                fobj.write(DECRYPT_KEYDEV)
-            if self.conf.yubikey:
-                fobj.write(DECRYPT_YUBICP % {'disk': self.conf.drive})
-            if self.conf.dropbear:
-                fobj.write(DROPBEAR % {'ip': self.conf.ip,
-                                       'gateway': self.conf.gateway,
-                                       'netmask': self.conf.netmask})
-            fobj.write(DECRYPT_PASSWORD)
+            if self.conf.race:
+                self._write_race(fobj, mark)
+            else:
+                self._write_sequence(fobj, mark)
             if self.conf.dropbear:
                 fobj.write("killall dropbear\n")
-            fobj.write(SWROOT)
-
-        os.chmod('init', 0b111101101)
+            mark('switch_root')
+            fobj.write(SWROOT % {'trace': TRACE_MOVE if self.conf.trace
+                                 else ''})
+            scripts['init'] = fobj.getvalue()
 
         if self.conf.dropbear:
-            with open('root/decrypt.sh', 'w') as fobj:
+            with io.StringIO() as fobj:
                 fobj.write(SHEBANG_ASH)
                 fobj.write(f"UUID='{self.conf.uuid}'\n")
                 if self.key:
                     fobj.write(f"KEY='/keys/{self.key}'\n")
+                fobj.write(WAIT_FOR)
                 fobj.write(DROPBEAR_SCRIPT)
-            os.chmod('root/decrypt.sh', 0b111101101)
+                scripts['root/decrypt.sh'] = fobj.getvalue()
+        return scripts
 
-        os.chdir(self.curdir)
+    def _generate_init(self):
+        for dest, script in self._scripts().items():
+            self._write(dest, script, 0b111101101)
+
+    def _commands(self):
+        """
+        Return names of the commands used by the generated scripts along
+        with the rescue shell ones, which are the only commands put into the
+        image in minimal mode.
+        """
+        commands = {'sh'}
+        commands.update(self.conf.rescue_commands or RESCUE_COMMANDS)
+        for script in self._scripts().values():
+            commands.update(_script_commands(script))
+        return commands
 
     def _mkcpio_arch(self):
-        _fd, self.cpio_arch = tempfile.mkstemp(suffix='.cpio')
-        os.close(_fd)
-        _fd, scriptname = tempfile.mkstemp(suffix='.sh')
-        os.close(_fd)
-        os.chdir(self.dirname)
-        with open(scriptname, 'w') as fobj:
-            fobj.write(SHEBANG)
-            fobj.write(MKCPIO % {'arch': self.cpio_arch})
-        os.chmod(scriptname, 0b111101101)
-        subprocess.call([scriptname])
-        os.chdir(self.curdir)
-        os.unlink(scriptname)
-
-        os.chmod(self.cpio_arch, 0b110100100)
+        # image is written on the target filesystem, so that it can be simply
+        # renamed in place
+        dest_dir = BOOT_DIR if self.conf.install else \
+            os.path.dirname(os.path.abspath(self.output))
+        _fd, self.cpio_arch = tempfile.mkstemp(prefix='.initramfs-',
+                                               suffix='.tmp', dir=dest_dir)
+        try:
+            with open(_fd, 'wb') as fobj:
+                add = self._add_all
+                if self.conf.layered:
+                    with open(self._layer(self._add_base), 'rb') as layer:
+                        shutil.copyfileobj(layer, fobj, CPIO_BUFSIZE)
+                    add = self._add_overlay
+                compressor = Compressor(fobj, self.conf.compression,
+                                        self.conf.compression_level,
+                                        self.conf.compression_threads)
+                with compressor as stream:
+                    writer = CpioWriter(stream, mtime=_source_date())
+                    add(writer)
+                    writer.close()
+                os.fchmod(fobj.fileno(), 0b110100100)
+                os.fsync(fobj.fileno())
+        except BaseException:
+            os.unlink(self.cpio_arch)
+            raise
+
+        self.timings.count(files=writer.entries, size=writer.offset,
+                           subprocesses=int(bool(compressor.command())))
 
         if self.conf.install:
-            self._make_boot_links()
+            if not self.defer_install:
+                _make_boot_links(self.cpio_arch, self.kernel_ver)
+        else:
+            os.replace(self.cpio_arch, self.output)
+
+    def _add_tree(self, writer, tree, select=None):
+        if isinstance(tree, dict):
+            writer.add_manifest(tree, select)
         else:
-            shutil.move(self.cpio_arch, 'initramfs.cpio')
+            writer.add_tree(tree, select)
+
+    def _add_all(self, writer):
+        # base and drive trees are merged into single stream, so that the
+        # image is the same as the one built without the shared base
+        trees = [(self.base, None)] if self.base else []
+        trees.append((self.dirname if self.manifest is None else
+                      self.manifest, None))
+        writer.add_trees(trees)
+
+    def _add_base(self, writer):
+        if self.base:
+            self._add_tree(writer, self.base)
+            return
+        overlay = self._overlay or ()
+        self._add_tree(writer, self.dirname if self.manifest is None else
+                       self.manifest, lambda name: name not in overlay)
+
+    def _add_overlay(self, writer):
+        if self.base:
+            self._add_tree(writer, self.dirname if self.manifest is None else
+                           self.manifest)
+            return
+        # parent directories are archived along with overlay entries, so
+        # the overlay is complete by itself
+        names = set()
+        for name in self._overlay:
+            while name and name not in names:
+                names.add(name)
+                name = os.path.dirname(name)
+        self._add_tree(writer, self.dirname if self.manifest is None else
+                       self.manifest, names.__contains__)
+
+    def _layer(self, add):
+        """
+        Return path to the compressed archive with the entries put by the add
+        function. Archive is taken from the cache, if the same entries were
+        compressed using the same method before.
+        """
+        writer = _LayerKey(mtime=_source_date())
+        add(writer)
+        writer.close()
+
+        conf = self.conf
+        name = (f'{writer.hexdigest()}-{conf.compression}-'
+                f'{conf.compression_level}')
+        layers = os.path.join(CACHE_PATH, 'layers')
+        path = os.path.join(layers, name)
+        try:
+            os.utime(path)
+            return path
+        except FileNotFoundError:
+            pass
+
+        os.makedirs(layers, exist_ok=True)
+        _fd, tmp = tempfile.mkstemp(prefix='.', dir=layers)
+        try:
+            with open(_fd, 'wb') as fobj:
+                with Compressor(fobj, conf.compression,
+                                conf.compression_level,
+                                conf.compression_threads) as stream:
+                    writer = CpioWriter(stream, mtime=_source_date())
+                    add(writer)
+                    writer.close()
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+        # keep only the recently used layers, other builds might be pruning
+        # them at the same time
+        paths = []
+        for fname in os.listdir(layers):
+            if fname.startswith('.'):
+                continue
+            try:
+                paths.append((os.path.getmtime(os.path.join(layers, fname)),
+                              fname))
+            except FileNotFoundError:
+                pass
+        for _, fname in sorted(paths)[:-LAYERS_KEPT]:
+            if fname == name:
+                continue
+            try:
+                os.unlink(os.path.join(layers, fname))
+            except FileNotFoundError:
+                pass
+        return path
+
+    def _cleanup(self):
+        if self.manifest is not None:
+            if self._strip_dir:
+                shutil.rmtree(self._strip_dir)
+            return
+        self._pool.shutdown(cancel_futures=True)
+        if not self.conf.cache:
+            shutil.rmtree(self.dirname)
+            return
+
+        with open(self.dirname + '.json', 'w') as fobj:
+            json.dump(self._records, fobj)
 
-    def _make_boot_links(self):
-        os.chdir('/boot')
-        current = None
-        old = None
+    def _check_compression(self):
+        method = self.conf.compression
+        if method not in COMPRESSION:
+            raise BuildError(10, f'Unknown compression method {method}.\n')
 
-        if os.path.exists('initramfs') and os.path.islink('initramfs'):
-            current = os.readlink('initramfs')
-            os.unlink('initramfs')
+        if (method not in ('none', 'gzip', 'xz') and
+                not Compressor(None, method).command()):
+            raise BuildError(10, f'Cannot find {method} command needed for '
+                             f'compression.\n')
 
-        if not current:
-            shutil.move(self.cpio_arch, 'initramfs-' + self.kernel_ver)
-            os.symlink('initramfs-' + self.kernel_ver, 'initramfs')
+        if not COMPRESSION[method]:
             return
 
-        if os.path.exists('initramfs.old') and os.path.islink('initramfs.old'):
-            old = os.readlink('initramfs.old')
-            os.unlink('initramfs.old')
-            os.unlink(old)
+        config = _kernel_config(self.kernel_ver, self.conf.root)
+        if config is None:
+            # gzip is supported by pretty much every kernel out there
+            if method == 'gzip':
+                return
+            sys.stderr.write(f'Warning: cannot find config for kernel '
+                             f'{self.kernel_ver}, unable to check whether '
+                             f'{method} compressed initramfs is supported.\n')
+        elif config.get(COMPRESSION[method]) != 'y':
+            raise BuildError(11, f'Kernel {self.kernel_ver} is not able to '
+                             f'unpack {method} compressed initramfs '
+                             f'({COMPRESSION[method]} is not set).\n')
+
+    def _phase(self, func, *args):
+        with self.timings.phase(func.__name__.lstrip('_')) as stats:
+            func(*args)
+            self._wait_copies()
+            # phases run one after another are always on the critical path
+            stats['critical'] = True
+
+    def _stages(self, parts):
+        _load_plugins()
+        return [stage for stage in STAGES if stage.part in parts and
+                (stage.when is None or stage.when(self.conf))]
+
+    def _run_stage(self, stage):
+        self._local.stage = stage
+        try:
+            with self.timings.phase(stage.name) as stats:
+                stage.func(self)
+                self._wait_copies()
+        finally:
+            self._local.stage = None
+        return stats
+
+    def _run_stages(self, parts):
+        """
+        Run the build stages of the given parts of the image. Stage is
+        started as soon as the stages providing its inputs are done, so that
+        independent stages run concurrently. Inputs which are not provided
+        by any of the stages are considered ready.
+        """
+        stages = self._stages(parts)
+        providers = {}
+        for stage in stages:
+            for output in stage.outputs:
+                providers.setdefault(output, set()).add(stage.name)
+        deps = {stage.name: {name for input_ in stage.inputs
+                             for name in providers.get(input_, ())
+                             if name != stage.name} for stage in stages}
+
+        ordered = set()
+        while len(ordered) < len(deps):
+            ready = {name for name, items in deps.items()
+                     if name not in ordered and items <= ordered}
+            if not ready:
+                names = ', '.join(sorted(deps.keys() - ordered))
+                raise BuildError(19, f'Stages {names} depend on each '
+                                 f'other.\n')
+            ordered |= ready
+
+        done = {}
+        running = {}
+        pending = list(stages)
+        error = None
+        with concurrent.futures.ThreadPoolExecutor(len(stages) or 1) as pool:
+            while running or pending and not error:
+                # after the failure no new stages are started, only the
+                # running ones are waited for
+                for stage in [stage for stage in pending if not error and
+                              deps[stage.name] <= done.keys()]:
+                    pending.remove(stage)
+                    running[pool.submit(self._run_stage, stage)] = stage
+                finished, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    stage = running.pop(future)
+                    try:
+                        done[stage.name] = future.result()
+                    except BaseException as exc:
+                        error = error or exc
+        if error:
+            raise error
+
+        # critical path is the chain of dependent stages taking longest
+        finish = {}
+        for name, stats in done.items():
+            finish[name] = stats['wall'] + max(
+                (finish[dep] for dep in deps[name]), default=0)
+        name = max(finish, key=finish.get, default=None)
+        while name:
+            done[name]['critical'] = True
+            name = max(deps[name], key=finish.get, default=None)
+
+    def build_base(self, name=None):
+        """
+        Prepare staging directory (or manifest) with the drive independent
+        part of the image, which might be shared by several builds. Returns
+        the path to the directory or the manifest itself.
+        """
+        self._make_tmp(name)
+        try:
+            # kernel modules are put on top of the base shared between
+            # kernels
+            self._run_stages(('base',) if self.conf.kernels else
+                             ('base', 'kernel'))
+            if self.conf.cache:
+                self._phase(self._prune)
+        except BaseException:
+            self._cleanup()
+            raise
+        if self.manifest is None:
+            # no copy threads should be left around while forking builders
+            self._pool.shutdown()
+        return self.dirname if self.manifest is None else self.manifest
+
+    def build(self, base=None):
+        """
+        Build the image. If base directory or manifest is provided, only
+        drive specific files are generated and put on top of it.
+        """
+        self.base = base
+        if self.conf.install:
+            with self.timings.phase('prebuilt'):
+                if self._prebuilt():
+                    return
+        self._check_compression()
+        self._make_tmp()
+        parts = ['drive']
+        if not base:
+            parts += ['base', 'kernel']
+        elif self.conf.kernels:
+            parts.append('kernel')
+        try:
+            self._run_stages(parts)
+            if self.conf.cache:
+                self._phase(self._prune)
+            self._phase(self._mkcpio_arch)
+        except BaseException:
+            self._cleanup()
+            raise
+        self._phase(self._cleanup)
+
+
+# build stages along with the resources they need and provide. Stages of the
+# base part are shared between the drives, those of the kernel part between
+# the drives and kernels, and drive part is specific for every image.
+Stage = collections.namedtuple('Stage', 'name func inputs outputs part when',
+                               defaults=((), (), 'drive', None))
+STAGES = [
+    Stage('make_dirs', Initramfs._make_dirs, outputs=('dirs',), part='base'),
+    Stage('copy_deps', Initramfs._copy_deps, ('dirs',), ('deps',), 'base'),
+    Stage('copy_modules', Initramfs._copy_modules, ('dirs',), ('modules',),
+          'kernel'),
+    Stage('populate_busybox', Initramfs._populate_busybox, ('dirs',),
+          ('applets',), 'base'),
+    Stage('strip', Initramfs._strip, ('deps', 'modules', 'applets'),
+          ('stripped',), 'base', lambda conf: conf.strip),
+    Stage('copy_dropbear_conf', Initramfs._copy_dropbear_conf, ('dirs',),
+          ('dropbear_conf',)),
+    Stage('copy_key', Initramfs._copy_keys, ('dirs',), ('key',),
+          when=lambda conf: not conf.no_key or conf.yubikey),
+    Stage('generate_init', Initramfs._generate_init, ('dirs', 'key'),
+          ('init',)),
+]
+_loaded_plugins = set()
+
+
+def register_stage(name, func, inputs=(), outputs=(), part='drive',
+                   when=None):
+    """
+    Add the build stage, or replace the one with the same name. Function is
+    called with the Initramfs instance, and when (if provided) with the
+    config, to decide whether the stage should be run at all.
+    """
+    stage = Stage(name, func, tuple(inputs), tuple(outputs), part, when)
+    for idx, item in enumerate(STAGES):
+        if item.name == name:
+            STAGES[idx] = stage
+            return
+    STAGES.append(stage)
 
-        shutil.move(current, current + '.old')
-        os.symlink(current + '.old', 'initramfs.old')
 
-        shutil.move(self.cpio_arch, 'initramfs-' + self.kernel_ver)
-        os.symlink('initramfs-' + self.kernel_ver, 'initramfs')
-        os.chdir(self.curdir)
+def _load_plugins():
+    """
+    Run the python scripts from the plugins directory, which are supposed
+    to call register_stage.
+    """
+    try:
+        fnames = sorted(os.listdir(PLUGINS_PATH))
+    except OSError:
+        return
+    for fname in fnames:
+        path = os.path.join(PLUGINS_PATH, fname)
+        if not fname.endswith('.py') or path in _loaded_plugins:
+            continue
+        _loaded_plugins.add(path)
+        runpy.run_path(path, {'register_stage': register_stage})
+
+
+def _build_drive(conf, base, output, kernel_ver=None):
+    init = Initramfs(conf, output, kernel_ver)
+    init.defer_install = True
+    init.build(base)
+    return init.timings.phases, init.cpio_arch
+
+
+def _install_images(conf, images):
+    """
+    Install images built for several kernels. The kernel /usr/src/linux
+    points to (if any) is installed first, along with initramfs links,
+    and the rest only replace their initramfs-<version> files.
+    """
+    default = _default_kernel(conf.root)
+    keep = {'initramfs-' + version for version in images}
+    if default in images:
+        _make_boot_links(images.pop(default), default, keep)
+    for version, path in images.items():
+        _install_image(path, version)
+
+
+def build_all(confs, jobs=None):
+    """
+    Build images for all the provided configs and their kernels. Drive
+    independent part of the image is prepared once for every set of drives
+    having the same base options, and images are built in parallel on top
+    of it. Returns the collected timings for the bases and every image.
+    """
+    groups = {}
+    for conf in confs:
+        key = conf.base_key()
+        if conf.minimal:
+            # applets and binaries in the base depend on the drive scripts
+            key += (tuple(sorted(Initramfs(conf)._commands())),)
+        groups.setdefault(key, []).append(conf)
+
+    bases = []
+    results = {}
+    futures = {}
+    try:
+        with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+            for key, group in groups.items():
+                versions = _kernel_versions(group[0])
+                init = Initramfs(group[0], kernel_ver=versions[0])
+                digest = hashlib.sha256(repr(key).encode()).hexdigest()
+                # failed base build is cleaned up by itself
+                base = init.build_base('base-' + digest[:12])
+                bases.append(init)
+                if group[0].layered:
+                    # compress the base once, before the drives are built
+                    init._check_compression()
+                    init._layer(init._add_base)
+                results['base-' + digest[:12]] = init.timings.phases
+                for conf in group:
+                    if not conf.kernels:
+                        futures[conf.drive, None] = pool.submit(
+                            _build_drive, conf, base,
+                            f'initramfs-{conf.drive}.cpio')
+                        continue
+                    for version in _kernel_versions(conf):
+                        name = version if len(confs) == 1 else \
+                            f'{conf.drive}-{version}'
+                        futures[conf.drive, version] = pool.submit(
+                            _build_drive, conf, base,
+                            f'initramfs-{name}.cpio', version)
+            images = {}
+            for (drive, version), future in futures.items():
+                phases, images[version] = future.result()
+                results[drive if version is None else
+                        f'{drive}-{version}'] = phases
+        if confs[0].install:
+            _install_images(confs[0], images)
+    finally:
+        for init in bases:
+            init._cleanup()
+        if confs[0].install:
+            # images which were not installed are left in /boot under
+            # temporary names
+            for future in futures.values():
+                if (future.done() and not future.cancelled() and
+                        future.exception() is None):
+                    path = future.result()[1]
+                    if os.path.exists(path):
+                        os.unlink(path)
+    return results
+
+
+class Inotify:
+    """
+    Minimal inotify binding, which reports paths of changed files in the
+    watched directories.
+    """
+    def __init__(self):
+        self._libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self._watches = {}
+
+    def add(self, path, mask=INOTIFY_MASK):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        self._watches[wd] = path
+
+    def read(self, timeout=None):
+        """
+        Return list of changed paths, waiting up to timeout seconds for any.
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        data = os.read(self.fd, 64 * 1024)
+        paths = []
+        offset = 0
+        while offset < len(data):
+            wd, _, _, size = struct.unpack_from('iIII', data, offset)
+            name = data[offset + 16:offset + 16 + size].rstrip(b'\0')
+            offset += 16 + size
+            if wd in self._watches:
+                paths.append(os.path.join(self._watches[wd],
+                                          os.fsdecode(name)))
+        return paths
+
+    def close(self):
+        os.close(self.fd)
+
+
+def _prebuild(confs, jobs=None):
+    """
+    Build images for all the configs and their kernels in the cache, skipping
+    those which inputs didn't change since they were built. Returns paths of
+    all the inputs.
+    """
+    prebuilt = os.path.join(CACHE_PATH, 'prebuilt')
+    os.makedirs(prebuilt, exist_ok=True)
+    inputs = set()
+    with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+        futures = {}
+        for conf in confs:
+            conf.install = False
+            for version in _kernel_versions(conf):
+                init = Initramfs(conf, kernel_ver=version)
+                paths = init._inputs()
+                inputs.update(paths)
+                path = os.path.join(prebuilt, f'{conf.drive}-{version}')
+                fingerprint = init._fingerprint(paths)
+                try:
+                    with open(path + '.json') as fobj:
+                        if json.load(fobj) == fingerprint:
+                            continue
+                except (OSError, ValueError):
+                    pass
+                futures[path] = fingerprint, pool.submit(
+                    _build_drive, conf, None, path, version)
+        for path, (fingerprint, future) in futures.items():
+            future.result()
+            with open(path + '.json', 'w') as fobj:
+                json.dump(fingerprint, fobj)
+            sys.stdout.write(f'Prebuilt image {os.path.basename(path)}.\n')
+    return inputs
+
+
+def watch(args, drives, jobs=None):
+    """
+    Keep images for the drives prebuilt in the cache, rebuilding them
+    whenever any of their inputs changes, so that install only has to put
+    them in place.
+    """
+    try:
+        inotify = Inotify()
+    except (AttributeError, OSError) as exc:
+        sys.stderr.write(f'Error: Cannot use inotify: {exc}\n')
+        sys.exit(18)
 
-    def _cleanup(self):
-        shutil.rmtree(self.dirname)
-
-    def build(self):
-        self._make_dirs()
-        self._copy_deps()
-        self._copy_modules()
-        # self._copy_wlan_modules()
-        self._populate_busybox()
-        if not self.conf.no_key:
-            self._copy_key()
-        if self.conf.yubikey:
-            self._copy_key('.yk')
-        self._generate_init()
-        self._mkcpio_arch()
-        self._cleanup()
+    inputs = set()
+    trees = set()
+    try:
+        while True:
+            try:
+                confs = [Config(args, _load_disks(), drive)
+                         for drive in drives]
+                trees = {_host_path(conf.root, '/lib/modules')
+                         for conf in confs}
+                inputs = _prebuild(confs, jobs)
+            except (BuildError, OSError, ValueError, SystemExit) as exc:
+                sys.stderr.write(f'Build failed ({exc}), waiting for '
+                                 f'changes.\n')
+            inputs.add(CONF_PATH)
+
+            # directories are watched instead of the files, so that files
+            # replaced by package manager are noticed
+            for path in {os.path.dirname(path) for path in inputs} | trees:
+                try:
+                    inotify.add(path)
+                except OSError:
+                    pass
+
+            while not any(path in inputs or os.path.dirname(path) in trees
+                          for path in inotify.read()):
+                pass
+            # wait until all the changes (like system upgrade) are done
+            while inotify.read(WATCH_DELAY):
+                pass
+    except KeyboardInterrupt:
+        pass
+    finally:
+        inotify.close()
 
 
 def _disks_msg(msg=None):
@@ -623,20 +3377,37 @@ def _disks_msg(msg=None):
         sys.stdout.write(msg + '\n')
 
 
-def _load_disks():
+def _read_disks():
+    """
+    Return the configuration, or None if there is no configuration file.
+    """
     try:
         with open(CONF_PATH, 'rb') as fobj:
             return tomllib.load(fobj)
     except IOError:
+        return None
+
+
+def _load_disks():
+    disks = _read_disks()
+    if disks is None:
         _disks_msg()
         sys.exit(1)
+    return disks
 
 
 def main():
-    disks = _load_disks()
-    if not disks:
-        _disks_msg()
-        sys.exit(3)
+    try:
+        _main()
+    except BuildError as exc:
+        sys.stderr.write(exc.message)
+        sys.exit(exc.code)
+
+
+def _main():
+    # configuration isn't needed for reporting boot timings nor inspecting
+    # images, so it's only required once the drives are about to be selected
+    disks = _read_disks()
 
     parser = argparse.ArgumentParser(description="Generate initramfs. It "
                                      "contain only necesairy things to unlock "
@@ -648,6 +3419,12 @@ def main():
                         'be created there and previous version will be '
                         'renamed with ".old" extension. Without this option, '
                         'initramfs will be generated in current directory.')
+    parser.add_argument('-K', '--kernel', action='append', dest='kernels',
+                        metavar='VERSION', help='Build the image for the '
+                        'kernel version instead of the one /usr/src/linux '
+                        'points to. Might be given several times, "all" '
+                        'means every kernel found in /lib/modules. Images '
+                        'are installed as initramfs-VERSION.')
     parser.add_argument('-m', '--copy-modules', action='store_true',
                         help='Copy kernel modules into initramfs image.')
     parser.add_argument('-n', '--no-key', action='store_true',
@@ -667,15 +3444,141 @@ def main():
     parser.add_argument('-b', '--dropbear', action='store_true',
                         help='Enable dropbear ssh server for remotely connect '
                         'to initrd.')
-    parser.add_argument('drive', choices=disks.keys(), help='Drive name')
+    parser.add_argument('-c', '--compression', choices=sorted(COMPRESSION),
+                        help='Compression method for the image, gzip by '
+                        'default.')
+    parser.add_argument('-L', '--compression-level', type=int,
+                        help='Compression level, default depends on the '
+                        'compression method.')
+    parser.add_argument('-T', '--compression-threads', type=int,
+                        help='Number of threads used for compression. Number '
+                        'of CPUs by default.')
+    parser.add_argument('-r', '--root', help='Take binaries, libraries and '
+                        'kernel modules from alternative root directory '
+                        'instead of /.')
+    parser.add_argument('-M', '--manifest', action='store_true',
+                        help='Do not copy anything into staging directory, '
+                        'put files into the archive straight from their '
+                        'locations.')
+    parser.add_argument('-C', '--cache', action='store_true',
+                        help='Keep the staging directory in cache between '
+                        'the builds and only copy files which have changed '
+                        'since the previous build.')
+    parser.add_argument('-S', '--strip', action='store_true',
+                        help='Strip binaries and libraries, and replace '
+                        'identical files with links.')
+    parser.add_argument('--minimal', action='store_true',
+                        help='Put only busybox applets and binaries used by '
+                        'the generated scripts, and the rescue shell '
+                        'commands, into the image.')
+    parser.add_argument('--timings', action='store_true',
+                        help='Print time spent, number of files, bytes and '
+                        'subprocesses for every build phase.')
+    parser.add_argument('--timings-json', metavar='FILE',
+                        help='Write build phases timings to the JSON file.')
+    parser.add_argument('-R', '--race', action='store_true',
+                        help='Run all the unlock methods (key device, '
+                        'yubikey, dropbear, password) at the same time, '
+                        'first one to open the root device wins.')
+    parser.add_argument('-e', '--layered', action='store_true',
+                        help='Build the image out of the compressed base '
+                        'part, which is cached, and small overlay with the '
+                        'drive specific files.')
+    parser.add_argument('-t', '--trace', action='store_true',
+                        help='Record time of every boot stage in '
+                        f'{BOOT_TIMINGS} file, which is kept after '
+                        'switching to the new root.')
+    parser.add_argument('--boot-timings', nargs='*', metavar='LOG',
+                        help='Summarize boot stages from the logs written '
+                        f'by init built with --trace ({BOOT_TIMINGS} by '
+                        'default) and exit.')
+    parser.add_argument('-p', '--plan', action='store_true',
+                        help='Only print what would be put into the image, '
+                        'its size compressed with every available method, '
+                        'and the largest files, and exit.')
+    parser.add_argument('--inspect', metavar='IMAGE',
+                        help='List the contents of existing image and exit.')
+    parser.add_argument('--diff', metavar='IMAGE',
+                        help='Compare existing image with the one which '
+                        'would be built for the drive and exit. Exit code is '
+                        '14, if they differ.')
+    parser.add_argument('-w', '--watch', action='store_true',
+                        help='Keep running and rebuild images in the cache '
+                        'whenever binaries, libraries, kernel modules, keys '
+                        'or the configuration change. Subsequent --install '
+                        'puts prebuilt image in place without building it.')
+    parser.add_argument('--list-deps', action='store_true',
+                        help='Only print binaries and libraries which would '
+                        'be copied to the initramfs and exit.')
+    parser.add_argument('-a', '--all', action='store_true',
+                        help='Build images for all the drives from the '
+                        'configuration.')
+    parser.add_argument('-j', '--jobs', type=int, help='Number of images '
+                        'built in parallel, when building for several '
+                        'drives. Number of CPUs by default.')
+    parser.add_argument('drive', nargs='*', help='Drive name(s), one of: ' +
+                        ', '.join(disks or ()))
 
     args = parser.parse_args()
-    if args.drive not in disks:
-        _disks_msg(f'Drive {args.drive} not found in configuration')
-        sys.exit(4)
-    conf = Config(args.__dict__, disks)
-    init = Initramfs(conf)
-    init.build()
+    if args.boot_timings is not None:
+        _report_boot_timings(args.boot_timings or [BOOT_TIMINGS])
+        return
+    if args.inspect:
+        _inspect(args.inspect)
+        return
+    if disks is None:
+        disks = _load_disks()
+    if not disks:
+        _disks_msg()
+        sys.exit(3)
+    drives = list(disks) if args.all else args.drive
+    if not drives:
+        parser.error('at least one drive name or --all option is required')
+    for drive in drives:
+        if drive not in disks:
+            _disks_msg(f'Drive {drive} not found in configuration')
+            sys.exit(4)
+    confs = [Config(args.__dict__, disks, drive) for drive in drives]
+
+    if args.watch:
+        watch(args.__dict__, drives, args.jobs)
+        return
+
+    if args.list_deps:
+        for conf in confs:
+            if len(confs) > 1:
+                sys.stdout.write(f'{conf.drive}:\n')
+            Initramfs(conf).list_deps()
+        return
+
+    if args.plan or args.diff:
+        for conf in confs:
+            conf.cache = False
+            conf.manifest = True
+        if args.diff:
+            if len(confs) > 1:
+                parser.error('only one drive can be compared with an image')
+            if Initramfs(confs[0]).diff(args.diff):
+                sys.exit(14)
+            sys.stdout.write('Image is up to date.\n')
+            return
+        for conf in confs:
+            Initramfs(conf).plan()
+        return
+
+    versions = _kernel_versions(confs[0])
+    if len(confs) == 1 and len(versions) == 1:
+        init = Initramfs(confs[0], kernel_ver=versions[0])
+        init.build()
+        results = {confs[0].drive: init.timings.phases}
+    else:
+        if len(confs) > 1 and any(conf.install for conf in confs):
+            sys.stderr.write('Only one drive can be installed at once.\n')
+            sys.exit(9)
+        results = build_all(confs, args.jobs)
+
+    if confs[0].timings or confs[0].timings_json:
+        _report_timings(results, confs[0].timings_json)
 
 
 if __name__ == "__main__":